@@ -2,11 +2,12 @@ import os
 import logging
 import time
 import uuid
+import hashlib
 import asyncio
 from datetime import datetime
 from typing import Optional, Dict, List
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Depends, status
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from starlette.middleware.cors import CORSMiddleware
@@ -15,11 +16,19 @@ from starlette.requests import Request
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from chatbot import Chatbot
 from token_middleware import validate_token_usage
-from database import get_user_token_balance, update_token_usage
+from database import init_db_client, close_db_client, get_db_metrics
+from database import run_chat_message_flusher, flush_chat_messages
+from database import get_chat_history_page, get_conversation_messages_page, invalidate_message_caches
+from database import load_subscription_tiers, run_subscription_tier_refresher
+from database import BOOTSTRAP_CACHE_PREFIX, BOOTSTRAP_CACHE_TTL, HISTORY_CACHE_STALE_TTL, bootstrap_cache_tags
+from database import chat_history_cache_tags, CHAT_PAGE_MAX_LIMIT
+from response_cache import get_cached_response, cache_json_response
+from token_ledger import reserve_tokens, commit_tokens, refund_tokens, run_reservation_reconciler
+from database import redis_manager as database_redis_manager
 from database import (
-    create_user, get_user_by_email, insert_chat_message, get_chat_history,
+    create_user, get_user_by_email, insert_chat_message,
     insert_video_analysis, get_video_analysis_history, check_user_exists,
-    get_user_conversations, create_conversation, get_conversation_messages,
+    get_user_conversations, create_conversation,
     update_conversation_title, delete_conversation, get_user_token_balance,
     get_user_subscription_tier, initialize_user_tokens
 )
@@ -27,9 +36,8 @@ from dotenv import load_dotenv
 import uvicorn
 from supabase.client import create_client, Client
 import jwt
-from fastapi.responses import Response
 from redis_storage import RedisFileStorage
-from redis_manager import RedisManager, TaskType, TaskPriority
+from redis_manager import TaskType, TaskPriority
 import secrets
 import httpx
 from session_config import (
@@ -122,7 +130,8 @@ if not redis_url:
     raise ValueError("REDIS_URL environment variable is not set")
 
 redis_storage = RedisFileStorage(redis_url)
-redis_manager = RedisManager(redis_url)
+# Share database.py's manager so in-process caches are not split across instances
+redis_manager = database_redis_manager
 
 supabase_url = os.environ.get("SUPABASE_URL")
 supabase_key = os.environ.get("SUPABASE_ANON_KEY")
@@ -148,7 +157,14 @@ async def startup_event():
     app.state.start_time = time.time()
     app.state.request_count = 0
     app.state.redis_manager = redis_manager
+    redis_manager.start_invalidation_listener()
     app.state.SESSION_REFRESH_THRESHOLD = SESSION_REFRESH_THRESHOLD
+    await init_db_client()
+    try:
+        await load_subscription_tiers()
+    except Exception as e:
+        # Lookups load the catalog lazily if the database is not reachable yet
+        logger.error(f"Error loading subscription tiers: {str(e)}")
     
     async def cleanup_sessions():
         while True:
@@ -182,9 +198,7 @@ async def startup_event():
                         )
                         
                         # Update caches
-                        if conversation_id:
-                            redis_manager.invalidate_cache(f"conversation:{conversation_id}")
-                        redis_manager.invalidate_cache(f"chat_history:{user_id}")
+                        invalidate_message_caches(user_id=user_id, conversation_id=conversation_id)
                 
             except Exception as e:
                 logger.error(f"Error processing message queue: {str(e)}")
@@ -194,6 +208,20 @@ async def startup_event():
     
     asyncio.create_task(cleanup_sessions())
     asyncio.create_task(process_message_queue())
+    asyncio.create_task(run_chat_message_flusher())
+    asyncio.create_task(run_reservation_reconciler())
+    asyncio.create_task(run_subscription_tier_refresher())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    try:
+        # Write out whatever is still buffered before the pool goes away
+        while await flush_chat_messages():
+            pass
+    except Exception as e:
+        logger.error(f"Error flushing chat messages on shutdown: {str(e)}")
+    await close_db_client()
+    redis_manager.stop_invalidation_listener()
 
 # Configure CORS with specific origin
 origins = [
@@ -267,6 +295,7 @@ async def signup(
                 status_code=500,
                 detail="Failed to create session"
             )
+        redis_manager.mark_user_verified(session_data["id"])
 
         response = JSONResponse(content={"success": True, "message": "Signup and login successful"})
         response.set_cookie(
@@ -333,6 +362,7 @@ async def login_post(
                 status_code=500,
                 detail="Failed to create session"
             )
+        redis_manager.mark_user_verified(session_data["id"])
 
         response = JSONResponse(content={"success": True, "message": "Login successful"})
         response.set_cookie(
@@ -421,21 +451,75 @@ async def stripe_success(request: Request):
 
 
 @app.get("/chat_history")
-async def get_chat_history_endpoint(request: Request):
+async def get_chat_history_endpoint(
+    request: Request,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    """Chat history, newest first; page back with `before` or poll with `after`"""
     user = await get_current_user(request)
     if not user:
         return JSONResponse(content={"history": []})
-    
-    cache_key = f"chat_history:{user['id']}"
-    cached_history = redis_manager.get_cache(cache_key)
-    
-    if cached_history:
-        logger.info(f"Returning cached chat history for user {user['id']}")
-        return JSONResponse(content={"history": cached_history})
-        
-    history = await get_chat_history(uuid.UUID(user['id']))
-    redis_manager.set_cache(cache_key, history)
-    return JSONResponse(content={"history": history})
+
+    # Head and older pages are served from the rendered bytes; polls with
+    # `after` are cursor-specific and always go to the database. The limit is
+    # clamped first so out-of-range values share one cache entry.
+    limit = max(1, min(limit, CHAT_PAGE_MAX_LIMIT))
+    tags = chat_history_cache_tags(user['id'])
+    cache_key = f"chat_history_response:{user['id']}:{limit}:{before or 'head'}"
+    generations = None
+    if not after:
+        cached, generations = get_cached_response(request, cache_key, tags)
+        if cached:
+            return cached
+
+    try:
+        page = await get_chat_history_page(uuid.UUID(user['id']), limit, before, after)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    content = {
+        "history": page["messages"],
+        "next_cursor": page["next_cursor"],
+        "newest_cursor": page["newest_cursor"],
+        "has_more": page["has_more"]
+    }
+    if after:
+        return JSONResponse(content=content)
+    return cache_json_response(request, cache_key, content, tags, generations)
+
+def cache_etag(request: Request, tags: List[str]) -> Optional[str]:
+    """
+    Weak ETag for a response built only from caches under `tags`, derived from
+    their generations so it is known before the body is loaded.
+    """
+    generations = redis_manager.get_generations(tags)
+    if generations is None:
+        return None
+    source = f"{request.url.path}?{request.url.query}|{','.join(tags)}|{generations}"
+    return f'W/"{hashlib.sha1(source.encode("utf-8")).hexdigest()[:20]}"'
+
+def not_modified(request: Request, etag: Optional[str]) -> Optional[Response]:
+    """A 304 response if the client already holds `etag`"""
+    if not etag:
+        return None
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    if header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+def etag_headers(etag: Optional[str]) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else {}
+
+async def get_cached_video_history(user_id: str) -> List[Dict]:
+    return await redis_manager.get_or_load(
+        f"video_history:{user_id}",
+        lambda: get_video_analysis_history(uuid.UUID(user_id)),
+        tags=[f"user:{user_id}", f"video_history:{user_id}"],
+        stale_ttl=HISTORY_CACHE_STALE_TTL
+    )
 
 @app.get("/video_analysis_history")
 async def get_video_analysis_history_endpoint(request: Request):
@@ -443,16 +527,56 @@ async def get_video_analysis_history_endpoint(request: Request):
     if not user:
         return JSONResponse(content={"history": []})
     
-    cache_key = f"video_history:{user['id']}"
-    cached_history = redis_manager.get_cache(cache_key)
-    
-    if cached_history:
-        logger.info(f"Returning cached video history for user {user['id']}")
-        return JSONResponse(content={"history": cached_history})
-        
-    history = await get_video_analysis_history(uuid.UUID(user['id']))
-    redis_manager.set_cache(cache_key, history)
-    return JSONResponse(content={"history": history})
+    # Polled by the frontend; unchanged polls are answered from the generations alone
+    etag = cache_etag(request, [f"user:{user['id']}", f"video_history:{user['id']}"])
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    history = await get_cached_video_history(user['id'])
+    return JSONResponse(content={"history": history}, headers=etag_headers(etag))
+
+@app.get("/api/bootstrap")
+async def bootstrap(request: Request):
+    """Everything the app needs on page load, fetched concurrently behind one session check"""
+    user = await get_current_user(request, return_none=True)
+    if not user:
+        return JSONResponse(content={"authenticated": False})
+
+    cache_key = f"{BOOTSTRAP_CACHE_PREFIX}{user['id']}"
+    snapshot = redis_manager.get_cache(cache_key, tags=bootstrap_cache_tags(user['id']))
+    if snapshot:
+        return JSONResponse(content=snapshot)
+
+    user_id = uuid.UUID(user['id'])
+    sections = ["token_balance", "subscription", "conversations", "chat_history", "video_history"]
+    results = await asyncio.gather(
+        get_user_token_balance(user_id),
+        get_user_subscription_tier(user_id),
+        get_user_conversations(user_id),
+        get_chat_history_page(user_id),
+        get_cached_video_history(user['id']),
+        return_exceptions=True
+    )
+
+    # One failing section should not blank the whole page; it is returned as null
+    snapshot = {
+        "authenticated": True,
+        "user": user,
+        "session_status": "active"
+    }
+    errors = []
+    for section, result in zip(sections, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error loading bootstrap section {section}: {str(result)}")
+            errors.append(section)
+            result = None
+        snapshot[section] = result
+    snapshot["errors"] = errors
+
+    # Only complete snapshots are cached
+    if not errors:
+        redis_manager.set_cache(cache_key, snapshot, ttl=BOOTSTRAP_CACHE_TTL, tags=bootstrap_cache_tags(user['id']))
+    return JSONResponse(content=snapshot)
 
 @app.get("/health")
 async def health_check():
@@ -504,6 +628,10 @@ async def metrics():
         metrics_data = {
             "timestamp": datetime.utcnow().isoformat(),
             "redis": redis_metrics,
+            "cache": redis_manager.get_cache_metrics(),
+            "database": get_db_metrics(),
+            "gemini": chatbot.dispatcher.get_metrics(),
+            "video_analysis": chatbot.get_analysis_metrics(),
             "app": {
                 "uptime": time.time() - app.state.start_time if hasattr(app.state, "start_time") else 0,
                 "requests_total": app.state.request_count if hasattr(app.state, "request_count") else 0,
@@ -556,13 +684,24 @@ async def get_conversations_endpoint(request: Request):
 @app.get("/conversations/{conversation_id}/messages")
 async def get_conversation_messages_endpoint(
     conversation_id: str,
-    request: Request
+    request: Request,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
 ):
-    """Get all messages in a conversation"""
+    """Messages in a conversation, newest first; page back with `before` or poll with `after`"""
     user = await get_current_user(request)
+    # Every message write bumps the conversation's generation, so polls with
+    # nothing new are answered without reading the messages
+    etag = cache_etag(request, [f"conversation:{conversation_id}"])
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
     try:
-        messages = await get_conversation_messages(uuid.UUID(conversation_id))
-        return JSONResponse(content={"messages": messages})
+        page = await get_conversation_messages_page(uuid.UUID(conversation_id), limit, before, after)
+        return JSONResponse(content=page, headers=etag_headers(etag))
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         logger.error(f"Error getting conversation messages: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -629,10 +768,7 @@ async def delete_conversation_endpoint(
             await delete_conversation(conv_id)
             
             # Clear related caches
-            cache_key = f"conversation:{conversation_id}"
-            redis_manager.invalidate_cache(cache_key)
-            if user and 'id' in user:
-                redis_manager.invalidate_cache(f"chat_history:{user['id']}")
+            invalidate_message_caches(user_id=user['id'], conversation_id=conversation_id)
                 
             return JSONResponse(content={"success": True})
         except ValueError as ve:
@@ -647,6 +783,10 @@ async def delete_conversation_endpoint(
             detail="An unexpected error occurred while deleting the conversation"
         )
 
+# Videos whose duration cannot be probed are charged as if they ran at this
+# bitrate. It is low on purpose, so the estimate errs toward a longer video.
+UNPROBED_VIDEO_BYTES_PER_SECOND = 125000  # 1 Mbit/s
+
 def convert_time_to_seconds(time_str: str) -> float:
     """Convert HH:MM:SS format to seconds"""
     try:
@@ -692,32 +832,65 @@ async def send_message(
                 )
                 
                 if await redis_storage.store_file(file_id, content):
-                    # Get video duration from metadata (assuming chatbot.analyze_video returns duration)
-                    analysis_text, metadata = await chatbot.analyze_video(
-                        file_id=file_id,
-                        filename=video.filename,
-                        conversation_id=conversation_id,
-                        user_id=user["id"]
-                    )
-                    
-                    # Validate token usage for video duration
-                    if metadata and 'duration' in metadata:
-                        # Convert duration to seconds
-                        video_duration = convert_time_to_seconds(metadata['duration'])
-                        user_id = uuid.UUID(user['id'])
-                        
-                        # Check if user has enough tokens
-                        current_balance = await get_user_token_balance(user_id)
-                        tokens_needed = int(video_duration)  # 1 token per second
-                        
-                        if current_balance < tokens_needed:
-                            raise HTTPException(
-                                status_code=402,
-                                detail=f"Insufficient tokens. Required: {tokens_needed}, Available: {current_balance}"
+                    user_id = uuid.UUID(user['id'])
+                    # One temp file feeds the probe here and the upload in analyze_video
+                    video_path = await chatbot.write_temp_video(content)
+                    hold = {"tokens": 0, "reservation_id": None}
+
+                    async def probe_and_reserve(path: str, size: int) -> Dict:
+                        # Hold the tokens for the probed duration. The upload runs
+                        # alongside this, but generation waits for it.
+                        probed = await chatbot.extract_video_metadata(path, size) or {}
+                        if 'duration' in probed:
+                            tokens_needed = int(convert_time_to_seconds(probed['duration']))  # 1 token per second
+                        else:
+                            tokens_needed = max(1, size // UNPROBED_VIDEO_BYTES_PER_SECOND)
+                            logger.warning(
+                                f"Could not probe the duration of {video.filename}; "
+                                f"charging an estimated {tokens_needed} tokens"
                             )
-                        
-                        # Deduct tokens for video processing
-                        await update_token_usage(user_id, tokens_needed)
+                        if tokens_needed:
+                            reservation_id = await reserve_tokens(user_id, tokens_needed)
+                            if not reservation_id:
+                                current_balance = await get_user_token_balance(user_id)
+                                raise HTTPException(
+                                    status_code=402,
+                                    detail=f"Insufficient tokens. Required: {tokens_needed}, Available: {current_balance}"
+                                )
+                            hold.update(tokens=tokens_needed, reservation_id=reservation_id)
+                        return probed
+
+                    reservation = asyncio.ensure_future(probe_and_reserve(video_path, len(content)))
+                    try:
+                        analysis_text, metadata = await chatbot.analyze_video(
+                            file_id=file_id,
+                            filename=video.filename,
+                            conversation_id=conversation_id,
+                            user_id=user["id"],
+                            probed_metadata=reservation,
+                            video_path=video_path
+                        )
+                        # Re-raises a 402 that ended the analysis early
+                        await reservation
+                    except Exception:
+                        if hold["reservation_id"]:
+                            await refund_tokens(user_id, hold["reservation_id"])
+                        raise
+                    finally:
+                        await chatbot.remove_temp_video(video_path)
+
+                    if hold["reservation_id"]:
+                        # A failed analysis comes back without metadata and is not charged;
+                        # an unprobeable video succeeds with empty metadata
+                        if metadata is not None:
+                            try:
+                                await commit_tokens(user_id, hold["reservation_id"], hold["tokens"])
+                            except Exception as e:
+                                # Recorded as unpaid and retried by the reservation
+                                # reconciler; the analysis is still returned
+                                logger.error(f"Deferred token charge for user {user_id}: {str(e)}")
+                        else:
+                            await refund_tokens(user_id, hold["reservation_id"])
                     
                     # Queue analysis task
                     redis_manager.enqueue_task(
@@ -731,9 +904,7 @@ async def send_message(
                         priority=TaskPriority.MEDIUM
                     )
                     
-                    # Invalidate cache before storing analysis
-                    redis_manager.invalidate_analysis_cache(user["id"])
-                    # Store analysis in background
+                    # Store analysis in background; the insert invalidates the history cache
                     asyncio.create_task(insert_video_analysis(
                         user_id=uuid.UUID(user['id']),
                         upload_file_name=video.filename,
@@ -778,13 +949,7 @@ async def send_message(
         # The bot response will be inserted by the worker when processing completes
         
         # Update both caches to maintain consistency
-        if conversation_id:
-            conv_cache_key = f"conversation:{conversation_id}"
-            redis_manager.invalidate_cache(conv_cache_key)
-        
-        # Also update user's chat history cache
-        user_cache_key = f"chat_history:{user['id']}"
-        redis_manager.invalidate_cache(user_cache_key)
+        invalidate_message_caches(user_id=user['id'], conversation_id=conversation_id)
         
         # Get updated token balance
         token_balance = await get_user_token_balance(uuid.UUID(user['id']))
@@ -795,6 +960,8 @@ async def send_message(
             "token_balance": token_balance
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -807,8 +974,10 @@ async def get_user_tokens(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     try:
-        token_balance = await get_user_token_balance(uuid.UUID(user['id']))
-        subscription = await get_user_subscription_tier(uuid.UUID(user['id']))
+        token_balance, subscription = await asyncio.gather(
+            get_user_token_balance(uuid.UUID(user['id'])),
+            get_user_subscription_tier(uuid.UUID(user['id']))
+        )
         
         return JSONResponse(content={
             "token_balance": token_balance,
@@ -32,6 +32,9 @@ async def get_current_user(request: Request, return_none: bool = False) -> Optio
                 return None
             raise HTTPException(status_code=401, detail="Invalid session data")
 
+        # A valid session implies the user exists; skips later existence queries
+        redis_manager.mark_user_verified(session_data['id'])
+
         # Check if session needs refresh
         current_time = time.time()
         last_refresh = session_data.get('last_refresh', 0)
@@ -0,0 +1,99 @@
+"""
+Benchmark cache value encodings: payload size and encode/decode time for the
+legacy JSON strings against the tagged JSON and msgpack codecs, with and
+without compression.
+
+Usage: python benchmarks/bench_cache_serializer.py
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_serializer import CacheCodec, JsonSerializer, MsgpackSerializer, decode, MSGPACK_AVAILABLE
+
+# Compression is opt-in, so the zlib variants set the threshold themselves
+ZLIB_THRESHOLD = 2048
+
+def build_page(rows: int) -> dict:
+    """A cached chat history page as stored by get_or_load"""
+    rng = random.Random(42)
+    words = "hook pain point dream outcome angle audience retention pacing creative offer proof".split()
+    user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    conversation_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    page = []
+    for i in range(rows):
+        page.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "message": " ".join(rng.choice(words) for _ in range(rng.randint(10, 200))),
+            "chat_type": rng.choice(["user", "bot"]),
+            "TIMESTAMP": (start - timedelta(minutes=i)).isoformat()
+        })
+    return {
+        "__cache_entry__": 1,
+        "value": {"rows": page, "has_more": True},
+        "delta": 0.012,
+        "expires_at": time.time() + 300
+    }
+
+def build_session() -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "email": "someone@example.com",
+        "name": "Some One",
+        "picture": "https://lh3.googleusercontent.com/a/photo",
+        "last_refresh": time.time()
+    }
+
+def legacy_encode(value) -> bytes:
+    """RedisManager._serialize_value before the codec"""
+    return json.dumps(value).encode("utf-8")
+
+def legacy_decode(data: bytes):
+    return json.loads(data.decode("utf-8"))
+
+def bench(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def compare(title: str, value, repeat: int):
+    codecs = [
+        ("legacy json", legacy_encode, legacy_decode),
+        ("json", CacheCodec(JsonSerializer(), compression_threshold=0).encode, decode),
+        ("json + zlib", CacheCodec(JsonSerializer(), compression_threshold=ZLIB_THRESHOLD).encode, decode),
+    ]
+    if MSGPACK_AVAILABLE:
+        codecs += [
+            ("msgpack", CacheCodec(MsgpackSerializer(), compression_threshold=0).encode, decode),
+            ("msgpack + zlib", CacheCodec(MsgpackSerializer(), compression_threshold=ZLIB_THRESHOLD).encode, decode),
+        ]
+
+    print(f"{title}, mean of {repeat} runs:")
+    print(f"  {'codec':<16} {'bytes':>9} {'encode':>12} {'decode':>12}")
+    for label, encode, decode_value in codecs:
+        data = encode(value)
+        assert decode_value(data) == value
+        encode_time = bench(lambda: encode(value), repeat)
+        decode_time = bench(lambda: decode_value(data), repeat)
+        print(f"  {label:<16} {len(data):>9,} {encode_time * 1000:9.3f} ms {decode_time * 1000:9.3f} ms")
+    print()
+
+def main():
+    if not MSGPACK_AVAILABLE:
+        print("msgpack is not installed; only JSON codecs are compared\n")
+    compare("session", build_session(), 5000)
+    for rows in (10, 50, 200):
+        compare(f"chat history page, {rows} rows", build_page(rows), max(20, 4000 // rows))
+
+if __name__ == "__main__":
+    main()
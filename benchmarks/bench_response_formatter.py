@@ -0,0 +1,84 @@
+"""
+Benchmark the response formatter against the previous line-by-line implementation.
+
+Usage: python benchmarks/bench_response_formatter.py
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_formatter import ResponseFormatter, format_response
+
+FILENAME = "3f2b8c1e-9a4d-4e6f-8b7a-1c2d3e4f5a6b_summer_campaign.mp4"
+
+def legacy_format_response(response: str, filename: str = '') -> str:
+    """The formatter as it was before response_formatter.py, kept as the reference"""
+    if filename:
+        uuid_pattern = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_'
+        clean_filename = re.sub(uuid_pattern, '', filename)
+        response = response.replace(filename, clean_filename)
+
+    lines = response.split('\n')
+    formatted_lines = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            line = re.sub(r'^#+\s*', '# ', line)
+        if line.startswith('•') or line.startswith('-'):
+            line = re.sub(r'^[•-]\s*', '- ', line)
+            if any(term in line.lower() for term in ['duration:', 'format:', 'resolution:', 'fps:', 'size:']):
+                line = f"  {line}"
+        formatted_lines.append(line)
+
+    return '\n\n'.join(formatted_lines)
+
+def build_response(sections: int) -> str:
+    """Synthetic video analysis shaped like real model output"""
+    rng = random.Random(42)
+    words = "hook pain point dream outcome angle audience retention pacing creative offer proof".split()
+    parts = [f"## Video Information\n- Filename: {FILENAME}\n  - Duration: 0:00:42\n  - Format: mp4\n  - Resolution: 1080x1920\n"]
+    for i in range(sections):
+        parts.append(f"### Section {i}\n")
+        for _ in range(6):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(8, 30)))
+            prefix = rng.choice(["• ", "- ", "* ", "", "   "])
+            parts.append(f"{prefix}{sentence.capitalize()}.\n")
+        parts.append("\n")
+    return "".join(parts)
+
+def bench(label: str, func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {label:<28} {elapsed * 1000:9.3f} ms")
+    return elapsed
+
+def stream(text: str, chunk_size: int) -> str:
+    formatter = ResponseFormatter(FILENAME)
+    out = [formatter.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    out.append(formatter.finish())
+    return "".join(out)
+
+def main():
+    for sections in (10, 100, 1000):
+        text = build_response(sections)
+        expected = legacy_format_response(text, FILENAME)
+        assert format_response(text, FILENAME) == expected
+        assert stream(text, 64) == expected
+
+        repeat = max(3, 2000 // sections)
+        print(f"{len(text):,} chars ({sections} sections), mean of {repeat} runs:")
+        legacy = bench("legacy _format_response", lambda: legacy_format_response(text, FILENAME), repeat)
+        current = bench("format_response", lambda: format_response(text, FILENAME), repeat)
+        bench("streamed, 64-char chunks", lambda: stream(text, 64), repeat)
+        print(f"  speedup: {legacy / current:.2f}x\n")
+
+if __name__ == "__main__":
+    main()
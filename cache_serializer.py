@@ -0,0 +1,126 @@
+import os
+import abc
+import json
+import zlib
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+# Tagged values start with a NUL byte, which never begins the plain JSON or
+# text values written before this module existed, followed by a format version
+# and one byte holding the codec ID plus flags.
+MAGIC = b"\x00"
+FORMAT_VERSION = 1
+HEADER_SIZE = 3
+FLAG_COMPRESSED = 0x80
+CODEC_MASK = 0x7F
+
+# Compression is off unless CACHE_COMPRESSION_THRESHOLD is set. zlib makes
+# chat history pages about 5x smaller, but encoding is 3-8x slower and every
+# Redis read pays 2-4x the decode time (see benchmarks/bench_cache_serializer.py).
+# Turn it on when Redis memory or bandwidth matters more than CPU.
+DEFAULT_COMPRESSION_THRESHOLD = int(os.environ.get("CACHE_COMPRESSION_THRESHOLD", "0"))
+DEFAULT_COMPRESSION_LEVEL = 1
+
+class Serializer(abc.ABC):
+    """A value encoding registered under a one-byte codec ID"""
+    codec_id = 0
+    name = ""
+
+    @abc.abstractmethod
+    def dumps(self, value: Any) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def loads(self, data: bytes) -> Any:
+        ...
+
+class JsonSerializer(Serializer):
+    codec_id = 1
+    name = "json"
+
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+class MsgpackSerializer(Serializer):
+    codec_id = 2
+    name = "msgpack"
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+SERIALIZERS: Dict[int, Serializer] = {}
+
+def register_serializer(serializer: Serializer):
+    if not 0 < serializer.codec_id <= CODEC_MASK:
+        raise ValueError(f"Codec ID must be between 1 and {CODEC_MASK}")
+    SERIALIZERS[serializer.codec_id] = serializer
+
+register_serializer(JsonSerializer())
+if MSGPACK_AVAILABLE:
+    register_serializer(MsgpackSerializer())
+
+def get_serializer(name: Optional[str] = None) -> Serializer:
+    """Look up a serializer by name; defaults to msgpack when it is installed"""
+    name = name or ("msgpack" if MSGPACK_AVAILABLE else "json")
+    for serializer in SERIALIZERS.values():
+        if serializer.name == name:
+            return serializer
+    raise ValueError(f"Unknown or unavailable cache serializer: {name}")
+
+def is_tagged(data: bytes) -> bool:
+    """True for values written by CacheCodec rather than the legacy JSON/text format"""
+    return len(data) >= HEADER_SIZE and data[:1] == MAGIC and data[1] == FORMAT_VERSION
+
+class CacheCodec:
+    """
+    Encodes values as version-tagged bytes: MAGIC, FORMAT_VERSION, then the
+    codec ID with FLAG_COMPRESSED set when the payload is zlib-compressed.
+
+    Payloads of at least `compression_threshold` bytes are zlib-compressed
+    when that makes them smaller; a threshold of 0 disables compression.
+    """
+
+    def __init__(
+        self,
+        serializer: Optional[Serializer] = None,
+        compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL
+    ):
+        self.serializer = serializer or get_serializer()
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+
+    def encode(self, value: Any) -> bytes:
+        payload = self.serializer.dumps(value)
+        flags = self.serializer.codec_id
+        if self.compression_threshold and len(payload) >= self.compression_threshold:
+            compressed = zlib.compress(payload, self.compression_level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_COMPRESSED
+        return MAGIC + bytes((FORMAT_VERSION, flags)) + payload
+
+def decode(data: bytes) -> Any:
+    """Decode a tagged value written by any codec; raises ValueError for unknown codecs"""
+    flags = data[2]
+    serializer = SERIALIZERS.get(flags & CODEC_MASK)
+    if serializer is None:
+        raise ValueError(f"No serializer registered for codec {flags & CODEC_MASK}")
+    payload = data[HEADER_SIZE:]
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    return serializer.loads(payload)
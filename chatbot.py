@@ -7,11 +7,16 @@ import datetime
 from datetime import timezone
 from dotenv import load_dotenv
 from moviepy.editor import VideoFileClip
-from typing import List, Dict, Optional, Tuple
+from typing import Awaitable, List, Dict, Optional, Tuple, Union
 import json
-import re
 import tempfile
+import time
+import hashlib
+import inspect
 from redis_storage import RedisFileStorage
+from gemini_dispatcher import GeminiDispatcher, estimate_tokens
+from conversation_context import ConversationContext
+from response_formatter import format_response
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -50,6 +55,12 @@ genai.configure(
 # Initialize Redis storage
 redis_storage = RedisFileStorage(redis_url)
 
+# Gemini bills video input at roughly 263 tokens per second of footage
+VIDEO_TOKENS_PER_SECOND = 263
+
+# Files API uploads are kept for 48 hours unless the API reports otherwise
+GEMINI_FILE_LIFETIME = 48 * 3600
+
 class Chatbot:
     def __init__(self):
         self.generation_config = genai.types.GenerationConfig(
@@ -73,9 +84,23 @@ class Chatbot:
             safety_settings=safety_settings
         )
 
+        # All Gemini calls go through the dispatcher for rate limiting and backoff
+        self.dispatcher = GeminiDispatcher()
+
+        # Files API readiness polling (adaptive backoff)
+        self.file_poll_initial_delay = 0.5
+        self.file_poll_backoff = 1.5
+        self.file_poll_max_delay = 5.0
+        self.file_processing_timeout = 600
+
+        # Per-stage latency aggregates for analyze_video
+        self.analysis_stage_stats = {}
+
         # Store sessions with user and conversation isolation
         # We'll store whether we've configured Helicone for this user_id already.
         self.sessions = {}  # {f"{user_id}:{conversation_id}": session_data}
+        # Session starts in flight, so concurrent first messages share one
+        self._session_starts: Dict[str, asyncio.Future] = {}
         self.system_prompt = """System Instructions:
 
 you are an expert marketer, you've generated billions, you know what makes consumers buy, what makes customers tick, their pain points, and their dream outcomes. Use your uncountable years of experience to provide meaningful insight to the user. If you are asked to iterate on winning ads focus on the parts of the ads that probably contributed most to its success based on your own judgement, with iterations focusing on dream outcomes and customer pain points and angles. If you do not have the ideal customer profile to do this ask the user if they can provide their detailed icp or if its okay for you to assume based on the videos uploaded. In any analysis or creation of ad ideas, you are always focusing on pain points, angles, and dream outcomes of customers Always assume questions are about the most recently analyzed video unless another video is specifically referenced. Absolutely don't mention uploading any new videos if not asked. If asked to analyze or explain again, just explain again without mentioning it was done again. When referring to previous content, be specific about which video you're discussing. 
@@ -281,33 +306,9 @@ Creative Optimization Strategies
 
     def _format_response(self, response: str, filename: str = '') -> str:
         """Format the response with clean markdown structure"""
-        if filename:
-            uuid_pattern = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_'
-            clean_filename = re.sub(uuid_pattern, '', filename)
-            response = response.replace(filename, clean_filename)
-
-        lines = response.split('\n')
-        formatted_lines = []
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
+        return format_response(response, filename)
 
-            # Convert multiple # to single #
-            if line.startswith('#'):
-                line = re.sub(r'^#+\s*', '# ', line)
-
-            # Format bullet points
-            if line.startswith('•') or line.startswith('-'):
-                line = re.sub(r'^[•-]\s*', '- ', line)
-                if any(term in line.lower() for term in ['duration:', 'format:', 'resolution:', 'fps:', 'size:']):
-                    line = f"  {line}"
-
-            formatted_lines.append(line)
-
-        return '\n\n'.join(formatted_lines)
-
-    def _get_or_create_session(self, conversation_id: str, user_id: str = None) -> dict:
+    async def _get_or_create_session(self, conversation_id: str, user_id: str = None) -> dict:
         """Get or create a new chat session for a conversation with user isolation"""
         if not conversation_id:
             raise ValueError("conversation_id is required for proper session isolation")
@@ -316,20 +317,13 @@ Creative Optimization Strategies
 
         session_key = f"{user_id}:{conversation_id}"
         if session_key not in self.sessions:
-            # Initialize chat session with system prompt
-            chat = self.model.start_chat(history=[])
-            # Send system prompt once at initialization
-            chat.send_message(self.system_prompt)
-            
-            self.sessions[session_key] = {
-                'chat_session': chat,
-                'chat_history': [],
-                'video_contexts': [],
-                'user_id': user_id,
-                'configured': False
-            }
-            # Store system prompt in history for reference
-            self._add_to_history(conversation_id, "system", self.system_prompt, user_id)
+            start = self._session_starts.get(session_key)
+            if start is None:
+                start = asyncio.ensure_future(self._start_session(session_key, user_id))
+                self._session_starts[session_key] = start
+                start.add_done_callback(lambda _: self._session_starts.pop(session_key, None))
+            # Shielded so one cancelled caller does not abort the start for the others
+            await asyncio.shield(start)
 
         session = self.sessions[session_key]
 
@@ -352,163 +346,325 @@ Creative Optimization Strategies
 
         return session
 
-    def _add_to_history(self, conversation_id: str, role: str, content: str, user_id: str = None):
-        """Add message to chat history with timezone-aware timestamp"""
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": datetime.datetime.now(timezone.utc).isoformat()
+    async def _start_session(self, session_key: str, user_id: str):
+        """Initialize a chat session with the system prompt and store it"""
+        chat = self.model.start_chat(history=[])
+        # Send system prompt once at initialization
+        await self.dispatcher.submit(
+            chat.send_message,
+            self.system_prompt,
+            estimated_tokens=estimate_tokens(self.system_prompt)
+        )
+
+        self.sessions[session_key] = {
+            'chat_session': chat,
+            'chat_history': ConversationContext(),
+            'video_contexts': [],
+            'user_id': user_id,
+            'configured': False
         }
 
+    def _add_to_history(self, conversation_id: str, role: str, content: str, user_id: str = None):
+        """Add message to chat history with timezone-aware timestamp"""
         session_key = f"{user_id}:{conversation_id}" if user_id else conversation_id
         session = self.sessions.get(session_key)
         if session:
-            session['chat_history'].append(message)
+            session['chat_history'].add(role, content, datetime.datetime.now(timezone.utc).isoformat())
 
-    async def extract_video_metadata(self, video_content: bytes) -> Optional[Dict]:
-        """Extract metadata from video content"""
-        temp_file = None
+    def _probe_video_file(self, path: str, size: int) -> Optional[Dict]:
+        """Read duration, fps and resolution from a video file on disk (blocking)"""
+        clip = VideoFileClip(path)
         try:
-            temp_file = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False)
-            temp_file.write(video_content)
-            temp_file.flush()
-
-            clip = VideoFileClip(temp_file.name)
-            metadata = {
+            return {
                 'duration': str(datetime.timedelta(seconds=int(clip.duration))),
                 'format': 'mp4',
-                'size': len(video_content),
+                'size': size,
                 'fps': clip.fps,
                 'resolution': f"{clip.size[0]}x{clip.size[1]}"
             }
+        finally:
             clip.close()
 
-            return metadata
+    def _write_temp_video(self, video_content: bytes) -> str:
+        """Write video bytes to a temporary file and return its path (blocking)"""
+        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
+            temp_file.write(video_content)
+            return temp_file.name
+
+    def _remove_temp_video(self, path: str):
+        try:
+            os.unlink(path)
+        except Exception as e:
+            logger.error(f"Error cleaning up temporary file: {str(e)}")
+
+    def _record_stage_timings(self, timings: Dict[str, float]):
+        """Fold one analysis run's stage timings into the running aggregates"""
+        for stage, elapsed_ms in timings.items():
+            stats = self.analysis_stage_stats.setdefault(
+                stage, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0}
+            )
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['last_ms'] = elapsed_ms
+
+    def get_analysis_metrics(self) -> Dict[str, Dict[str, float]]:
+        """Per-stage latency summary for video analysis"""
+        return {
+            stage: {
+                'count': stats['count'],
+                'avg_ms': round(stats['total_ms'] / stats['count'], 2) if stats['count'] else 0,
+                'max_ms': round(stats['max_ms'], 2),
+                'last_ms': round(stats['last_ms'], 2)
+            }
+            for stage, stats in self.analysis_stage_stats.items()
+        }
+
+    async def write_temp_video(self, video_content: bytes) -> str:
+        """Write video bytes to a temporary file; the caller removes it with remove_temp_video"""
+        return await asyncio.to_thread(self._write_temp_video, video_content)
+
+    async def remove_temp_video(self, path: str):
+        await asyncio.to_thread(self._remove_temp_video, path)
+
+    async def extract_video_metadata(self, path: str, size: int) -> Optional[Dict]:
+        """Extract metadata from a video file on disk; None if it cannot be read"""
+        try:
+            return await asyncio.to_thread(self._probe_video_file, path, size)
         except Exception as e:
             logger.error(f"Error extracting video metadata: {str(e)}")
             return None
-        finally:
-            if temp_file:
-                try:
-                    temp_file.close()
-                    os.unlink(temp_file.name)
-                except Exception as e:
-                    logger.error(f"Error cleaning up temporary file: {str(e)}")
 
-    async def analyze_video(self, file_id: str, filename: str, conversation_id: str, user_id: str, prompt: str = '') -> tuple[str, Optional[Dict]]:
-        """Analyze video content from Redis storage"""
+    async def _wait_for_file_active(self, video_file):
+        """Poll the Files API until processing finishes, backing off between checks"""
+        delay = self.file_poll_initial_delay
+        deadline = time.monotonic() + self.file_processing_timeout
+        while video_file.state.name == "PROCESSING":
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Video processing timed out after {self.file_processing_timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * self.file_poll_backoff, self.file_poll_max_delay)
+            video_file = await self.dispatcher.run_file_operation(genai.get_file, video_file.name)
+
+        if video_file.state.name == "FAILED":
+            raise ValueError(f"Video processing failed: {video_file.state.name}")
+        return video_file
+
+    async def _delete_gemini_file(self, video_file):
+        """Delete an uploaded file that will not be analysed"""
+        try:
+            await self.dispatcher.run_file_operation(genai.delete_file, video_file.name)
+        except Exception as e:
+            logger.error(f"Error deleting Gemini file {video_file.name}: {str(e)}")
+
+    async def _discard_upload(self, operation):
+        """Delete the file an abandoned upload produces, once it finishes"""
+        try:
+            video_file = await operation
+        except Exception:
+            return
+        await self._delete_gemini_file(video_file)
+
+    def _content_digest(self, video_content: bytes) -> str:
+        return hashlib.sha256(video_content).hexdigest()
+
+    async def _get_reusable_file(self, digest: str) -> Optional[Tuple[object, Optional[Dict]]]:
+        """Return the uploaded Gemini file and metadata for this content if still usable"""
+        record = await redis_storage.get_gemini_file(digest)
+        if not record:
+            return None
+        try:
+            video_file = await self.dispatcher.run_file_operation(genai.get_file, record['name'])
+            video_file = await self._wait_for_file_active(video_file)
+        except Exception as e:
+            logger.info(f"Gemini file {record['name']} is no longer usable: {str(e)}")
+            await redis_storage.delete_gemini_file(digest)
+            return None
+        if video_file.state.name != "ACTIVE":
+            await redis_storage.delete_gemini_file(digest)
+            return None
+        return video_file, record['metadata']
+
+    async def _remember_file(self, digest: str, video_file, metadata: Optional[Dict]):
+        """Record the Gemini file for this content digest"""
+        expiration = getattr(video_file, 'expiration_time', None)
+        expires_at = expiration.timestamp() if expiration else time.time() + GEMINI_FILE_LIFETIME
+        await redis_storage.set_gemini_file(digest, video_file.name, expires_at, metadata)
+
+    async def analyze_video(
+        self,
+        file_id: str,
+        filename: str,
+        conversation_id: str,
+        user_id: str,
+        prompt: str = '',
+        probed_metadata: Optional[Union[Dict, Awaitable[Optional[Dict]]]] = None,
+        video_path: Optional[str] = None
+    ) -> tuple[str, Optional[Dict]]:
+        """
+        Analyze video content from Redis storage.
+
+        `probed_metadata` replaces the probe; an awaitable is awaited alongside
+        the upload, and generation does not start until it resolves. Pass
+        `video_path` to upload a temp file the caller already wrote.
+        """
+        timings = {}
+
+        async def timed(stage: str, coro):
+            started = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                timings[stage] = (time.perf_counter() - started) * 1000
+
+        async def probe(path: Optional[str], size: int) -> Optional[Dict]:
+            if probed_metadata is None:
+                return await self.extract_video_metadata(path, size)
+            if inspect.isawaitable(probed_metadata):
+                return await probed_metadata
+            return probed_metadata
+
+        uploaded = []
+
+        async def upload(path: str):
+            logger.info(f"Uploading video file: {path}")
+            operation = asyncio.ensure_future(self.dispatcher.run_file_operation(
+                genai.upload_file,
+                path=path,
+                mime_type="video/mp4"
+            ))
+            try:
+                video_file = await timed('upload', asyncio.shield(operation))
+            except asyncio.CancelledError:
+                # The upload thread cannot be interrupted; delete what it uploads
+                asyncio.ensure_future(self._discard_upload(operation))
+                raise
+            uploaded.append(video_file)
+            logger.info("Waiting for video processing...")
+            return await timed('processing', self._wait_for_file_active(video_file))
+
+        analysis_started = time.perf_counter()
         try:
             logger.info(f"Retrieving video content for file ID: {file_id}")
-            video_content = await redis_storage.retrieve_file(file_id)
+            video_content = await timed('retrieve', redis_storage.retrieve_file(file_id))
             if video_content is None:
                 raise ValueError(f"Failed to retrieve video content for file ID: {file_id}")
 
-            metadata = await self.extract_video_metadata(video_content)
-
-            temp_file = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False)
-            try:
-                temp_file.write(video_content)
-                temp_file.flush()
-                logger.info(f"Uploading video file: {temp_file.name}")
-
-                video_file = genai.upload_file(
-                    path=temp_file.name,
-                    mime_type="video/mp4"
-                )
-
-                logger.info("Waiting for video processing...")
-                # Reduced sleep from 2s to 1s to check more frequently for readiness
-                while video_file.state.name == "PROCESSING":
-                    await asyncio.sleep(1)
-                    video_file = genai.get_file(video_file.name)
-
-                if video_file.state.name == "FAILED":
-                    raise ValueError(f"Video processing failed: {video_file.state.name}")
-
-                context_prompt = self._create_analysis_prompt(filename, metadata)
-                if prompt:
-                    context_prompt += f"\n\nAdditional instructions: {prompt}"
-
-                session = self._get_or_create_session(conversation_id, user_id)
-
-                # Reconfigure once here for video analysis requests with video_upload property
-                genai.configure(
-                    api_key=api_key,
-                    client_options={
-                        'api_endpoint': 'gateway.helicone.ai',
-                    },
-                    default_metadata=[
-                        ('helicone-auth', f'Bearer {helicone_api_key}'),
-                        ('helicone-target-url', 'https://generativelanguage.googleapis.com'),
-                        ('Helicone-User-Id', user_id),
-                        ('Helicone-Property-video_upload', 'video_upload')
-                    ],
-                    transport="rest"
-                )
-
-                response = await asyncio.to_thread(session['chat_session'].send_message, [video_file, context_prompt])
-                response_text = self._format_response(response.text, filename)
-
-                self._add_to_history(conversation_id, "system", f"Video Analysis ({filename}): {response_text}", user_id)
-                session['video_contexts'].append({
-                    'file_id': file_id,
-                    'filename': filename,
-                    'analysis': response_text,
-                    'metadata': metadata
-                })
-
-                # After this video analysis completes, we might want to restore the configuration without video_upload
-                # to avoid reconfiguration on next user message. However, if messages are frequent, consider caching.
-                # We'll restore default user config:
-                genai.configure(
-                    api_key=api_key,
-                    client_options={
-                        'api_endpoint': 'gateway.helicone.ai',
-                    },
-                    default_metadata=[
-                        ('helicone-auth', f'Bearer {helicone_api_key}'),
-                        ('helicone-target-url', 'https://generativelanguage.googleapis.com'),
-                        ('Helicone-User-Id', user_id)
-                    ],
-                    transport="rest"
-                )
+            # The same content may already be uploaded, by this conversation or another
+            digest = await asyncio.to_thread(self._content_digest, video_content)
+            reused = await timed('lookup', self._get_reusable_file(digest))
+
+            if reused:
+                video_file, metadata = reused
+                if probed_metadata is not None:
+                    metadata = await timed('probe', probe(None, 0)) or metadata
+                logger.info(f"Reusing Gemini file {video_file.name} for file ID: {file_id}")
+                session = await timed('session', self._get_or_create_session(conversation_id, user_id))
+            else:
+                # One temp file feeds both the probe and the upload
+                temp_path = video_path or await timed('write', self.write_temp_video(video_content))
+                # Probe, upload/processing and session warm-up overlap
+                tasks = [
+                    asyncio.ensure_future(timed('probe', probe(temp_path, len(video_content)))),
+                    asyncio.ensure_future(upload(temp_path)),
+                    asyncio.ensure_future(timed('session', self._get_or_create_session(conversation_id, user_id)))
+                ]
+                try:
+                    # The first failure, such as a rejected reservation, stops the
+                    # rest instead of leaving the upload polling until it times out
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                    failure = next((task.exception() for task in done if task.exception()), None)
+                    if failure:
+                        raise failure
+                    metadata, video_file, session = (task.result() for task in tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    for uploaded_file in uploaded:
+                        await self._delete_gemini_file(uploaded_file)
+                    raise
+                finally:
+                    if not video_path:
+                        await self.remove_temp_video(temp_path)
+
+            await self._remember_file(digest, video_file, metadata)
+
+            context_prompt = self._create_analysis_prompt(filename, metadata)
+            if prompt:
+                context_prompt += f"\n\nAdditional instructions: {prompt}"
+
+            # Reconfigure once here for video analysis requests with video_upload property
+            genai.configure(
+                api_key=api_key,
+                client_options={
+                    'api_endpoint': 'gateway.helicone.ai',
+                },
+                default_metadata=[
+                    ('helicone-auth', f'Bearer {helicone_api_key}'),
+                    ('helicone-target-url', 'https://generativelanguage.googleapis.com'),
+                    ('Helicone-User-Id', user_id),
+                    ('Helicone-Property-video_upload', 'video_upload')
+                ],
+                transport="rest"
+            )
 
-                return response_text, metadata
+            estimated_tokens = estimate_tokens(context_prompt) + self._estimate_video_tokens(metadata)
+            response = await timed('generate', self.dispatcher.submit(
+                session['chat_session'].send_message,
+                [video_file, context_prompt],
+                estimated_tokens=estimated_tokens
+            ))
+            response_text = self._format_response(response.text, filename)
+
+            self._add_to_history(conversation_id, "system", f"Video Analysis ({filename}): {response_text}", user_id)
+            session['video_contexts'].append({
+                'file_id': file_id,
+                'filename': filename,
+                'analysis': response_text,
+                'metadata': metadata,
+                'gemini_file_name': video_file.name,
+                'digest': digest
+            })
+
+            # After this video analysis completes, we might want to restore the configuration without video_upload
+            # to avoid reconfiguration on next user message. However, if messages are frequent, consider caching.
+            # We'll restore default user config:
+            genai.configure(
+                api_key=api_key,
+                client_options={
+                    'api_endpoint': 'gateway.helicone.ai',
+                },
+                default_metadata=[
+                    ('helicone-auth', f'Bearer {helicone_api_key}'),
+                    ('helicone-target-url', 'https://generativelanguage.googleapis.com'),
+                    ('Helicone-User-Id', user_id)
+                ],
+                transport="rest"
+            )
 
-            finally:
-                try:
-                    temp_file.close()
-                    os.unlink(temp_file.name)
-                except Exception as e:
-                    logger.error(f"Error cleaning up temporary file: {str(e)}")
+            return response_text, metadata
 
         except Exception as e:
             logger.error(f"Error analyzing video: {str(e)}")
             return f"An error occurred during video analysis: {str(e)}", None
+        finally:
+            timings['total'] = (time.perf_counter() - analysis_started) * 1000
+            self._record_stage_timings(timings)
+            logger.info(
+                f"Video analysis stage timings for {file_id}: " +
+                ", ".join(f"{stage}={elapsed:.0f}ms" for stage, elapsed in timings.items())
+            )
 
     async def send_message(self, message: str, conversation_id: str, user_id: str) -> str:
         """Send a message while maintaining context for a specific conversation"""
         try:
-            session = self._get_or_create_session(conversation_id, user_id)
+            session = await self._get_or_create_session(conversation_id, user_id)
             self._add_to_history(conversation_id, "user", message, user_id)
 
-            # Get recent history excluding system prompts
-            recent_messages = []
-            history_count = 0
-            for msg in reversed(session['chat_history']):
-                if msg['content'] != self.system_prompt:
-                    recent_messages.append(msg)
-                    history_count += 1
-                    if history_count >= 5:
-                        break
-            recent_messages.reverse()
-
-            # Format message history for context
-            formatted_history = []
-            for msg in recent_messages:
-                role = "User" if msg['role'] == "user" else "Assistant"
-                formatted_history.append(f"{role}: {msg['content']}")
-            
+            # Recent history within the token budget, long turns summarized
+            formatted_history = session['chat_history'].build()
+
             context_prompt = message
             if formatted_history:
                 context_prompt = (
@@ -519,7 +675,11 @@ Creative Optimization Strategies
                 )
 
             # Send message with context
-            response = await asyncio.to_thread(session['chat_session'].send_message, context_prompt)
+            response = await self.dispatcher.submit(
+                session['chat_session'].send_message,
+                context_prompt,
+                estimated_tokens=estimate_tokens(context_prompt)
+            )
             response_text = self._format_response(response.text)
 
             self._add_to_history(conversation_id, "bot", response_text, user_id)
@@ -531,6 +691,16 @@ Creative Optimization Strategies
                 return "I apologize, but the API quota has been exceeded. Please try again in a few minutes."
             return "I apologize, but there was an unexpected error. Please try again."
 
+    def _estimate_video_tokens(self, metadata: Optional[Dict]) -> int:
+        """Estimate the input tokens a video will cost from its probed duration"""
+        if not metadata or not metadata.get('duration'):
+            return VIDEO_TOKENS_PER_SECOND * 60
+        try:
+            hours, minutes, seconds = (float(part) for part in metadata['duration'].split(':'))
+            return int((hours * 3600 + minutes * 60 + seconds) * VIDEO_TOKENS_PER_SECOND)
+        except (ValueError, TypeError):
+            return VIDEO_TOKENS_PER_SECOND * 60
+
     def _create_analysis_prompt(self, filename: str, metadata: Optional[Dict]) -> str:
         """Create the analysis prompt with proper context"""
         context_prompt = (
@@ -0,0 +1,103 @@
+import os
+import re
+from collections import deque
+from typing import List, Optional
+
+from gemini_dispatcher import estimate_tokens
+
+# Token budget for the conversation context sent with each message
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# Turns larger than this are always sent as a summary (e.g. long video analyses)
+DEFAULT_MAX_TURN_TOKENS = int(os.getenv("CONTEXT_MAX_TURN_TOKENS", "600"))
+# Number of recent turns kept verbatim in the ring buffer
+DEFAULT_RING_SIZE = 20
+
+SUMMARY_CHARS = 280
+FOLDED_SUMMARY_CHARS = 120
+MAX_FOLDED_SUMMARIES = 10
+
+_whitespace_pattern = re.compile(r'\s+')
+_markdown_pattern = re.compile(r'[#*`>]+')
+
+def summarize_text(text: str, max_chars: int) -> str:
+    """Compact one-line summary: strip markdown, collapse whitespace, cut on a word"""
+    text = _whitespace_pattern.sub(' ', _markdown_pattern.sub('', text)).strip()
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(' ', 0, max_chars)
+    return text[:cut if cut > 0 else max_chars].rstrip(' ,.;:') + '…'
+
+def role_label(role: str) -> str:
+    return "User" if role == "user" else "Assistant"
+
+class ConversationContext:
+    """
+    Bounded per-conversation history used to build prompt context.
+
+    Recent turns live in a fixed-size ring buffer together with their token
+    estimate and a precomputed summary. Turns that fall out of the ring are
+    folded into a short list of one-line summaries, so building the context
+    costs the same however long the conversation gets.
+    """
+
+    def __init__(
+        self,
+        ring_size: int = DEFAULT_RING_SIZE,
+        token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+        max_turn_tokens: int = DEFAULT_MAX_TURN_TOKENS
+    ):
+        self.turns = deque(maxlen=ring_size)
+        self.folded = deque(maxlen=MAX_FOLDED_SUMMARIES)
+        self.token_budget = token_budget
+        self.max_turn_tokens = max_turn_tokens
+
+    def add(self, role: str, content: str, timestamp: Optional[str] = None):
+        """Append a turn, folding the oldest one into a summary if the ring is full"""
+        if len(self.turns) == self.turns.maxlen:
+            oldest = self.turns[0]
+            self.folded.append(
+                f"{role_label(oldest['role'])}: {summarize_text(oldest['content'], FOLDED_SUMMARY_CHARS)}"
+            )
+
+        line = f"{role_label(role)}: {content}"
+        summary_line = f"{role_label(role)} (summary): {summarize_text(content, SUMMARY_CHARS)}"
+        self.turns.append({
+            'role': role,
+            'content': content,
+            'timestamp': timestamp,
+            'line': line,
+            'tokens': estimate_tokens(line),
+            'summary_line': summary_line,
+            'summary_tokens': estimate_tokens(summary_line)
+        })
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def build(self, token_budget: Optional[int] = None) -> List[str]:
+        """Return context lines, oldest first, whose estimated size fits the budget"""
+        remaining = self.token_budget if token_budget is None else token_budget
+        selected = []
+
+        # Newest turns get the budget first; verbatim if small enough, else summarized
+        for turn in reversed(self.turns):
+            if turn['tokens'] <= self.max_turn_tokens and turn['tokens'] <= remaining:
+                selected.append(turn['line'])
+                remaining -= turn['tokens']
+            elif turn['summary_tokens'] <= remaining:
+                selected.append(turn['summary_line'])
+                remaining -= turn['summary_tokens']
+            else:
+                break
+
+        selected.reverse()
+
+        # Older turns still in the ring that did not fit are dropped; the folded
+        # summaries cover only turns evicted from the ring, and only if they fit
+        if remaining > 0 and self.folded:
+            earlier = "Earlier in this conversation: " + " | ".join(self.folded)
+            earlier_tokens = estimate_tokens(earlier)
+            if earlier_tokens <= remaining:
+                selected.insert(0, earlier)
+
+        return selected
@@ -1,10 +1,18 @@
 import os
+import json
+import time
+import base64
+import asyncio
 import logging
 from datetime import datetime, timezone
+from types import MappingProxyType
 logger = logging.getLogger(__name__)
+import httpx
+from postgrest import AsyncPostgrestClient
 from supabase.client import create_client, Client
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, Optional
 import uuid
+from redis.exceptions import WatchError
 from redis_manager import RedisManager
 
 redis_manager = RedisManager(os.environ.get('REDIS_URL'))
@@ -16,8 +24,107 @@ supabase_key = os.environ.get("SUPABASE_ANON_KEY")
 if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URL or SUPABASE_ANON_KEY is missing from environment variables")
 
+# The sync client is only used for Supabase Auth; all table access goes through PostgREST below
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# PostgREST connection pool settings
+DB_CALL_TIMEOUT = float(os.environ.get("SUPABASE_CALL_TIMEOUT", "10"))
+DB_CONNECT_TIMEOUT = float(os.environ.get("SUPABASE_CONNECT_TIMEOUT", "5"))
+DB_MAX_CONNECTIONS = int(os.environ.get("SUPABASE_MAX_CONNECTIONS", "50"))
+DB_MAX_KEEPALIVE = int(os.environ.get("SUPABASE_MAX_KEEPALIVE", "20"))
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """AsyncPostgrestClient that runs on a shared httpx connection pool"""
+
+    def __init__(self, http_client: httpx.AsyncClient):
+        self._http_client = http_client
+        super().__init__(str(http_client.base_url), headers=dict(http_client.headers))
+
+    def create_session(self, *args, **kwargs) -> httpx.AsyncClient:
+        return self._http_client
+
+_http_client: Optional[httpx.AsyncClient] = None
+_postgrest_client: Optional[PooledPostgrestClient] = None
+_db_metrics: Dict[str, Dict[str, float]] = {}
+
+def _create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=f"{supabase_url}/rest/v1",
+        headers={
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        },
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(DB_CALL_TIMEOUT, connect=DB_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=DB_MAX_CONNECTIONS,
+            max_keepalive_connections=DB_MAX_KEEPALIVE,
+            keepalive_expiry=30
+        ),
+        follow_redirects=True
+    )
+
+async def init_db_client() -> None:
+    """Create the shared PostgREST client; called from the app startup hook"""
+    db()
+    logger.info(f"Initialized PostgREST client (HTTP/2: {HTTP2_AVAILABLE})")
+
+async def close_db_client() -> None:
+    """Close the shared connection pool; called from the app shutdown hook"""
+    global _http_client, _postgrest_client
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _postgrest_client = None
+
+def db() -> PooledPostgrestClient:
+    """Get the shared PostgREST client, creating it on first use outside the app"""
+    global _http_client, _postgrest_client
+    if _postgrest_client is None:
+        _http_client = _create_http_client()
+        _postgrest_client = PooledPostgrestClient(_http_client)
+    return _postgrest_client
+
+async def _execute(operation: str, query) -> Any:
+    """Execute a PostgREST query with a per-call timeout, recording its latency"""
+    stats = _db_metrics.setdefault(
+        operation, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+    )
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(query.execute(), timeout=DB_CALL_TIMEOUT)
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+def get_db_metrics() -> Dict[str, Any]:
+    """Per-operation PostgREST latency and error counts"""
+    return {
+        "http2": HTTP2_AVAILABLE,
+        "operations": {
+            operation: {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["calls"], 2) if stats["calls"] else 0,
+                "max_ms": round(stats["max_ms"], 2)
+            }
+            for operation, stats in _db_metrics.items()
+        }
+    }
+
 async def create_user(email: str, password: str) -> Dict:
     try:
         # Check if user already exists
@@ -26,7 +133,7 @@ async def create_user(email: str, password: str) -> Dict:
             raise ValueError("User with this email already exists")
             
         # Create user with auth
-        auth_response = supabase.auth.sign_up({
+        auth_response = await asyncio.to_thread(supabase.auth.sign_up, {
             "email": email,
             "password": password
         })
@@ -35,22 +142,581 @@ async def create_user(email: str, password: str) -> Dict:
             raise ValueError("Failed to create user authentication")
             
         # Create user record in users table
-        response = supabase.table("users").insert({
+        response = await _execute("users.insert", db().table("users").insert({
             "id": auth_response.user.id,
             "email": email
-        }).execute()
+        }))
         
         return response.data[0] if response.data else {}
     except Exception as e:
         raise ValueError(f"Error creating user: {str(e)}")
 
 async def get_user_by_email(email: str) -> Dict:
-    response = supabase.table("users").select("*").eq("email", email).execute()
+    response = await _execute("users.select", db().table("users").select("*").eq("email", email))
     return response.data[0] if response.data else {}
 
 async def check_user_exists(user_id: uuid.UUID) -> bool:
-    response = supabase.table("users").select("id").eq("id", str(user_id)).execute()
-    return len(response.data) > 0
+    if redis_manager.is_user_verified(str(user_id)):
+        return True
+    response = await _execute("users.select", db().table("users").select("id").eq("id", str(user_id)))
+    exists = len(response.data) > 0
+    if exists:
+        redis_manager.mark_user_verified(str(user_id))
+    return exists
+
+# Write-behind persistence for chat messages: rows are appended to a Redis list
+# on the request path and bulk-inserted into Supabase by a background flusher
+CHAT_WRITE_QUEUE_KEY = "chat_write:queue"
+CHAT_WRITE_ATTEMPTS_KEY = "chat_write:attempts"
+CHAT_WRITE_LOCK_KEY = "chat_write:lock"
+CHAT_WRITE_DLQ_KEY = f"{redis_manager.dlq_prefix}chat_write"
+CHAT_PENDING_CONVERSATION_PREFIX = "chat_write:pending:conversation:"
+CHAT_PENDING_USER_PREFIX = "chat_write:pending:user:"
+CHAT_PENDING_TTL = 86400
+CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL_MS", "250")) / 1000
+CHAT_FLUSH_BATCH_SIZE = int(os.environ.get("CHAT_FLUSH_BATCH_SIZE", "100"))
+CHAT_FLUSH_MAX_ATTEMPTS = 5
+CHAT_FLUSH_MAX_BACKOFF = 30.0
+CHAT_FLUSH_LOCK_MS = 30000
+
+# Compare-and-delete so a flusher never releases a lock another worker now holds
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# ARGV: token, ttl in ms. Extends the lock only while this flusher still holds it
+_EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_chat_flush_event: Optional[asyncio.Event] = None
+
+def _get_chat_flush_event() -> asyncio.Event:
+    global _chat_flush_event
+    if _chat_flush_event is None:
+        _chat_flush_event = asyncio.Event()
+    return _chat_flush_event
+
+def _parse_timestamp(value: Optional[str]) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return datetime.min.replace(tzinfo=timezone.utc)
+
+def _chat_row_identity(row: Dict) -> tuple:
+    return (
+        str(row.get("conversation_id")),
+        row.get("chat_type"),
+        row.get("message"),
+        _parse_timestamp(row.get("TIMESTAMP"))
+    )
+
+def _get_pending_chat_rows(key: str) -> List[Dict]:
+    """Rows appended to the write buffer but not yet flushed to Supabase"""
+    try:
+        return [json.loads(raw) for raw in redis_manager.redis.lrange(key, 0, -1)]
+    except Exception as e:
+        logger.error(f"Error reading pending chat messages: {str(e)}")
+        return []
+
+def _row_position(row: Dict) -> tuple:
+    # Unflushed rows have no id yet and sort after flushed rows with the same timestamp
+    row_id = row.get("id")
+    return (_parse_timestamp(row.get("TIMESTAMP")), float("inf") if row_id is None else row_id)
+
+def _merge_pending_chat_rows(rows: List[Dict], pending: List[Dict], limit: Optional[int] = None) -> List[Dict]:
+    """Merge unflushed rows into a newest-first result so nothing appears to go missing"""
+    if not pending:
+        return rows
+    seen = {_chat_row_identity(row) for row in rows}
+    merged = rows + [row for row in pending if _chat_row_identity(row) not in seen]
+    merged.sort(key=_row_position, reverse=True)
+    return merged[:limit] if limit else merged
+
+def _enqueue_chat_row(row: Dict) -> None:
+    """Durably append a row to the write buffer and the per-reader pending lists"""
+    payload = json.dumps(row)
+    conversation_key = f"{CHAT_PENDING_CONVERSATION_PREFIX}{row['conversation_id']}"
+    user_key = f"{CHAT_PENDING_USER_PREFIX}{row['user_id']}"
+    with redis_manager.redis.pipeline() as pipe:
+        pipe.rpush(CHAT_WRITE_QUEUE_KEY, payload)
+        pipe.rpush(conversation_key, payload)
+        pipe.expire(conversation_key, CHAT_PENDING_TTL)
+        pipe.rpush(user_key, payload)
+        pipe.expire(user_key, CHAT_PENDING_TTL)
+        _push_recent_message(pipe, row, payload)
+        queue_length = pipe.execute()[0]
+
+    if queue_length >= CHAT_FLUSH_BATCH_SIZE:
+        _get_chat_flush_event().set()
+
+async def _insert_chat_rows(rows: List[Dict]) -> List[Dict]:
+    """
+    Write buffered rows, skipping any whose client_id is already stored, so a
+    batch that is written twice is not duplicated. Returns the rows inserted.
+    """
+    response = await _execute(
+        "user_chat_history.insert",
+        db().table("user_chat_history").upsert(rows, on_conflict="client_id", ignore_duplicates=True)
+    )
+    return response.data or []
+
+async def _hold_chat_flush_lock(lock_token: str) -> None:
+    """Keep extending the flush lock while a batch is being written"""
+    while True:
+        await asyncio.sleep(CHAT_FLUSH_LOCK_MS / 3000)
+        if not redis_manager.redis.eval(_EXTEND_LOCK_SCRIPT, 1, CHAT_WRITE_LOCK_KEY, lock_token, CHAT_FLUSH_LOCK_MS):
+            logger.warning("Chat flush lock expired while a batch was being written")
+            return
+
+async def _insert_chat_rows_individually(raw_rows: List[bytes], rows: List[Dict]) -> tuple:
+    """Insert rows one at a time in order; returns the raw rows that failed and the rows inserted"""
+    failed, written = [], []
+    for raw, row in zip(raw_rows, rows):
+        try:
+            written.extend(await _insert_chat_rows([row]))
+        except Exception as e:
+            logger.error(f"Chat message {row.get('client_id')} could not be written: {str(e)}")
+            failed.append(raw)
+    if len(failed) == len(rows):
+        raise ValueError("No buffered chat messages could be written")
+    return failed, written
+
+async def flush_chat_messages() -> int:
+    """Bulk-insert the oldest buffered chat messages; returns the number of rows handled"""
+    lock_token = str(uuid.uuid4())
+    if not redis_manager.redis.set(CHAT_WRITE_LOCK_KEY, lock_token, nx=True, px=CHAT_FLUSH_LOCK_MS):
+        return 0
+    # Row-by-row fallback inserts can outlast CHAT_FLUSH_LOCK_MS
+    lock_keeper = asyncio.ensure_future(_hold_chat_flush_lock(lock_token))
+    try:
+        raw_rows = redis_manager.redis.lrange(CHAT_WRITE_QUEUE_KEY, 0, CHAT_FLUSH_BATCH_SIZE - 1)
+        if not raw_rows:
+            return 0
+        rows = [json.loads(raw) for raw in raw_rows]
+
+        # The batch stays at the head of the queue until written, so per-conversation
+        # order holds across retries. Repeated failures fall back to row-by-row
+        # inserts so one bad row cannot block the queue forever.
+        failed = []
+        try:
+            written = await _insert_chat_rows(rows)
+        except Exception:
+            attempts = redis_manager.redis.incr(CHAT_WRITE_ATTEMPTS_KEY)
+            if attempts < CHAT_FLUSH_MAX_ATTEMPTS:
+                raise
+            failed, written = await _insert_chat_rows_individually(raw_rows, rows)
+
+        # From the LREMs below until conversations.summary is updated, an index
+        # rebuild sees these rows neither pending nor counted
+        index_windows = _open_conversation_index_window(list({row["user_id"] for row in rows}))
+        with redis_manager.redis.pipeline() as pipe:
+            # If the lock was lost, another flusher may already have trimmed this
+            # batch; leave the queue alone and let the next flush rewrite it,
+            # which the client_id upsert makes harmless
+            pipe.watch(CHAT_WRITE_LOCK_KEY)
+            if pipe.get(CHAT_WRITE_LOCK_KEY) != lock_token.encode("utf-8"):
+                raise ValueError("Chat flush lock was lost before the batch was committed")
+            pipe.multi()
+            pipe.ltrim(CHAT_WRITE_QUEUE_KEY, len(raw_rows), -1)
+            pipe.delete(CHAT_WRITE_ATTEMPTS_KEY)
+            for raw, row in zip(raw_rows, rows):
+                pipe.lrem(f"{CHAT_PENDING_CONVERSATION_PREFIX}{row['conversation_id']}", 1, raw)
+                pipe.lrem(f"{CHAT_PENDING_USER_PREFIX}{row['user_id']}", 1, raw)
+            if failed:
+                pipe.rpush(CHAT_WRITE_DLQ_KEY, *failed)
+            pipe.execute()
+
+        failed_rows = set(failed)
+        # The recent lists hold the buffered form of each row, which has no id
+        # yet; swap in the stored row so cursors taken from it are exact
+        _replace_recent_messages(written)
+        written_ids = {row.get("client_id") for row in written}
+        # Dead-lettered rows, and rows an earlier attempt already stored (so
+        # the upsert did not return them), are rebuilt from Postgres instead
+        unmatched = [
+            row for raw, row in zip(raw_rows, rows)
+            if raw in failed_rows or row["client_id"] not in written_ids
+        ]
+        if unmatched:
+            _drop_recent_messages(unmatched)
+        # Dead-lettered rows were counted in the indexed summaries when buffered;
+        # rebuild those from conversations.summary, which only counts stored rows
+        for user_id in {row["user_id"] for raw, row in zip(raw_rows, rows) if raw in failed_rows}:
+            _drop_conversation_index(user_id)
+        await _record_conversation_activity([
+            row for raw, row in zip(raw_rows, rows) if raw not in failed_rows
+        ])
+        for user_id, version in index_windows.items():
+            _close_conversation_index_window(user_id, version)
+
+        # Cached reads taken while rows were pending no longer include them
+        for conversation_id in {row["conversation_id"] for row in rows}:
+            invalidate_message_caches(conversation_id=conversation_id)
+        for user_id in {row["user_id"] for row in rows}:
+            invalidate_message_caches(user_id=user_id)
+
+        return len(rows)
+    finally:
+        lock_keeper.cancel()
+        redis_manager.redis.eval(_RELEASE_LOCK_SCRIPT, 1, CHAT_WRITE_LOCK_KEY, lock_token)
+
+async def run_chat_message_flusher() -> None:
+    """Flush the chat write buffer every CHAT_FLUSH_INTERVAL or once a batch fills"""
+    event = _get_chat_flush_event()
+    delay = CHAT_FLUSH_INTERVAL
+    while True:
+        try:
+            await asyncio.wait_for(event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+        try:
+            written = await flush_chat_messages()
+            delay = CHAT_FLUSH_INTERVAL
+            if written >= CHAT_FLUSH_BATCH_SIZE:
+                # More rows are probably waiting; drain without sleeping
+                event.set()
+        except Exception as e:
+            delay = min(max(delay, CHAT_FLUSH_INTERVAL) * 2, CHAT_FLUSH_MAX_BACKOFF)
+            logger.error(f"Error flushing chat messages, retrying in {delay:.2f}s: {str(e)}")
+
+# Keyset pagination over (TIMESTAMP, id). Cursors are opaque to clients.
+CHAT_MESSAGE_COLUMNS = "id, user_id, conversation_id, message, chat_type, TIMESTAMP"
+CHAT_PAGE_MAX_LIMIT = 200
+# History caches are fresh for the default cache TTL, then served stale for up
+# to this long while a background refresh runs
+HISTORY_CACHE_STALE_TTL = int(os.environ.get("HISTORY_CACHE_STALE_TTL", "600"))
+
+def encode_cursor(row: Dict) -> str:
+    payload = json.dumps({"ts": row.get("TIMESTAMP"), "id": row.get("id")}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        ts = payload["ts"]
+        datetime.fromisoformat(ts)
+        row_id = payload.get("id")
+        if row_id is not None:
+            row_id = int(row_id)
+        return {"ts": ts, "id": row_id}
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+async def _select_beyond_cursor(column: str, value: str, cursor: Optional[Dict], newer: bool, count: int) -> List[Dict]:
+    """
+    Up to `count` messages past a (TIMESTAMP, id) cursor, oldest-first when
+    `newer` and newest-first otherwise.
+
+    The keyset condition is split into two bounded queries, one for later
+    timestamps and one for ties on the cursor timestamp, because the
+    PostgREST client cannot express the OR between them.
+    """
+    def build(apply):
+        query = db().table("user_chat_history").select(CHAT_MESSAGE_COLUMNS).eq(column, value)
+        # Both sort keys go in one order param; each .order() call adds its own
+        order = "TIMESTAMP,id" if newer else "TIMESTAMP.desc,id"
+        return apply(query).order(order, desc=not newer).limit(count)
+
+    if cursor is None:
+        response = await _execute("user_chat_history.select", build(lambda query: query))
+        return response.data or []
+
+    op = "gt" if newer else "lt"
+    queries = [build(lambda query: getattr(query, op)("TIMESTAMP", cursor["ts"]))]
+    if cursor["id"] is not None:
+        queries.insert(0, build(
+            lambda query: getattr(query.eq("TIMESTAMP", cursor["ts"]), op)("id", cursor["id"])
+        ))
+    responses = await asyncio.gather(
+        *(_execute("user_chat_history.select", query) for query in queries)
+    )
+    # Ties on the cursor timestamp come before every later timestamp in the
+    # direction of travel, so the results concatenate in order
+    rows = [row for response in responses for row in (response.data or [])]
+    return rows[:count]
+
+# Write-through recent messages: the newest rows of each conversation and each
+# user's history, newest first, in a capped list. New messages are pushed in
+# the same transaction that buffers them, so head pages and polls are served
+# from Redis and Postgres is only read to build a list the first time.
+RECENT_MESSAGES_PREFIX = "recent_messages:"
+RECENT_MESSAGES_CAP = int(os.environ.get("RECENT_MESSAGES_CAP", "100"))
+RECENT_MESSAGES_TTL = 86400
+
+# KEYS: list, state, version; ARGV: row, cap, ttl
+# The state is "complete" while the list holds every message and "partial" once
+# trimmed. Every push bumps the version so a build that raced with it is
+# discarded; only built lists are pushed to, so a partial one is never served.
+_PUSH_RECENT_MESSAGE_SCRIPT = """
+redis.call('incr', KEYS[3])
+redis.call('expire', KEYS[3], ARGV[3])
+if redis.call('exists', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('lpush', KEYS[1], ARGV[1])
+if redis.call('llen', KEYS[1]) > tonumber(ARGV[2]) then
+    redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    redis.call('set', KEYS[2], 'partial')
+end
+redis.call('expire', KEYS[1], ARGV[3])
+redis.call('expire', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: list, version; ARGV: client_id, row, ttl
+# Replaces the buffered row with that client_id by its stored form
+_REPLACE_RECENT_MESSAGE_SCRIPT = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+local rows = redis.call('lrange', KEYS[1], 0, -1)
+for i, raw in ipairs(rows) do
+    local ok, row = pcall(cjson.decode, raw)
+    if ok and row['client_id'] == ARGV[1] then
+        redis.call('lset', KEYS[1], i - 1, ARGV[2])
+        return 1
+    end
+end
+return 0
+"""
+
+CHAT_MESSAGE_FIELDS = tuple(column.strip() for column in CHAT_MESSAGE_COLUMNS.split(","))
+
+def _public_chat_row(row: Dict) -> Dict:
+    """A message as returned to clients, without client_id or other internal columns"""
+    return {field: row.get(field) for field in CHAT_MESSAGE_FIELDS}
+
+def _recent_message_keys(scope: str) -> tuple:
+    list_key = f"{RECENT_MESSAGES_PREFIX}{scope}"
+    return list_key, f"{list_key}:state", f"{list_key}:version"
+
+def _recent_message_scopes(row: Dict) -> List[str]:
+    # Matches the cache prefixes of get_conversation_messages_page and get_chat_history_page
+    return [f"conversation:{row['conversation_id']}", f"chat_history:{row['user_id']}"]
+
+def _push_recent_message(pipe, row: Dict, payload: str) -> None:
+    for scope in _recent_message_scopes(row):
+        pipe.eval(
+            _PUSH_RECENT_MESSAGE_SCRIPT, 3, *_recent_message_keys(scope),
+            payload, RECENT_MESSAGES_CAP, RECENT_MESSAGES_TTL
+        )
+
+def _replace_recent_messages(rows: List[Dict]) -> None:
+    """Swap buffered rows in the recent lists for their stored forms"""
+    try:
+        with redis_manager.redis.pipeline(transaction=False) as pipe:
+            for row in rows:
+                payload = json.dumps(_public_chat_row(row))
+                for scope in _recent_message_scopes(row):
+                    list_key, _, version_key = _recent_message_keys(scope)
+                    pipe.eval(
+                        _REPLACE_RECENT_MESSAGE_SCRIPT, 2, list_key, version_key,
+                        row["client_id"], payload, RECENT_MESSAGES_TTL
+                    )
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Error replacing recent messages: {str(e)}")
+
+def _drop_recent_messages(rows: List[Dict]) -> None:
+    """Force the next read of these rows' lists to rebuild from Postgres"""
+    scopes = {scope for row in rows for scope in _recent_message_scopes(row)}
+    if not scopes:
+        return
+
+    def drop():
+        with redis_manager.redis.pipeline() as pipe:
+            for scope in scopes:
+                list_key, state_key, version_key = _recent_message_keys(scope)
+                pipe.delete(list_key, state_key)
+                # Also discards a build that read Postgres before the change
+                pipe.incr(version_key)
+                pipe.expire(version_key, RECENT_MESSAGES_TTL)
+            pipe.execute()
+
+    try:
+        redis_manager._retry_operation(drop)
+    except Exception as e:
+        logger.error(f"Error dropping recent messages: {str(e)}")
+
+def _read_recent_messages(scope: str) -> Optional[tuple]:
+    """(rows newest first, complete) from the list, or None if it needs building"""
+    list_key, state_key, _ = _recent_message_keys(scope)
+    with redis_manager.redis.pipeline(transaction=False) as pipe:
+        pipe.get(state_key)
+        pipe.lrange(list_key, 0, -1)
+        state, raw_rows = pipe.execute()
+    if state is None:
+        return None
+    rows = [json.loads(raw) for raw in raw_rows]
+    # Concurrent inserts can push slightly out of order
+    rows.sort(key=_row_position, reverse=True)
+    return rows, state == b"complete"
+
+def _build_recent_messages(scope: str, rows: List[Dict], complete: bool, version: Optional[bytes]) -> None:
+    """Store a freshly loaded list unless a message was pushed since `version` was read"""
+    list_key, state_key, version_key = _recent_message_keys(scope)
+    with redis_manager.redis.pipeline() as pipe:
+        try:
+            pipe.watch(version_key)
+            if pipe.get(version_key) != version:
+                return
+            pipe.multi()
+        except WatchError:
+            return
+        pipe.delete(list_key)
+        if rows:
+            pipe.rpush(list_key, *[json.dumps(row) for row in rows])
+            pipe.expire(list_key, RECENT_MESSAGES_TTL)
+        pipe.set(state_key, "complete" if complete else "partial", ex=RECENT_MESSAGES_TTL)
+        try:
+            pipe.execute()
+        except WatchError:
+            pass
+
+async def _get_recent_messages(column: str, value: str, scope: str, pending_key: str) -> tuple:
+    """Up to RECENT_MESSAGES_CAP newest rows and whether they are all there is"""
+    try:
+        recent = _read_recent_messages(scope)
+        if recent is not None:
+            return recent
+    except Exception as e:
+        logger.error(f"Error reading recent messages: {str(e)}")
+
+    version = None
+    try:
+        version = redis_manager.redis.get(_recent_message_keys(scope)[2])
+    except Exception as e:
+        logger.error(f"Error reading recent messages version: {str(e)}")
+    response = await _execute(
+        "user_chat_history.select",
+        db().table("user_chat_history").select(CHAT_MESSAGE_COLUMNS).eq(column, value)
+        .order("TIMESTAMP.desc,id", desc=True).limit(RECENT_MESSAGES_CAP + 1)
+    )
+    db_rows = response.data or []
+    merged = _merge_pending_chat_rows(db_rows[:RECENT_MESSAGES_CAP], _get_pending_chat_rows(pending_key))
+    complete = len(db_rows) <= RECENT_MESSAGES_CAP and len(merged) <= RECENT_MESSAGES_CAP
+    rows = merged[:RECENT_MESSAGES_CAP]
+    try:
+        _build_recent_messages(scope, rows, complete, version)
+    except Exception as e:
+        logger.error(f"Error building recent messages: {str(e)}")
+    return rows, complete
+
+def _message_page_cache_key(cache_prefix: str, limit: int, before: Optional[str]) -> str:
+    return f"{cache_prefix}:page:{limit}:{before or 'head'}"
+
+async def _get_message_page(
+    column: str,
+    value: str,
+    cache_prefix: str,
+    pending_key: str,
+    limit: int,
+    before: Optional[str],
+    after: Optional[str],
+    tags: List[str],
+    stale_ttl: int = 0
+) -> Dict[str, Any]:
+    """
+    Fetch one page of chat messages filtered on `column`.
+
+    `before` pages backwards from a cursor; `after` returns only messages newer
+    than a cursor, for polling. The head page and `after` results come from the
+    write-through recent list when it covers them; otherwise unflushed rows
+    from the write buffer are merged in. Older pages are cached as-is.
+    """
+    if before and after:
+        raise ValueError("Only one of before and after can be given")
+    limit = max(1, min(limit, CHAT_PAGE_MAX_LIMIT))
+    before_cursor = decode_cursor(before) if before else None
+    after_cursor = decode_cursor(after) if after else None
+    floor = _row_position({"TIMESTAMP": after_cursor["ts"], "id": after_cursor["id"]}) if after_cursor else None
+
+    recent = None
+    if not before_cursor and limit <= RECENT_MESSAGES_CAP:
+        recent = await _get_recent_messages(column, value, cache_prefix, pending_key)
+        recent_rows, complete = recent
+        if after_cursor and not complete and (not recent_rows or _row_position(recent_rows[-1]) > floor):
+            # The list does not reach back to the cursor
+            recent = None
+
+    if recent is not None:
+        recent_rows, complete = recent
+        if after_cursor:
+            newer = [row for row in recent_rows if _row_position(row) > floor]
+            has_more = len(newer) > limit
+            rows = newer[-limit:]
+        else:
+            rows = recent_rows[:limit]
+            has_more = len(recent_rows) > limit or not complete
+    elif after_cursor:
+        # Oldest-first so a burst larger than `limit` is returned without gaps
+        rows = await _select_beyond_cursor(column, value, after_cursor, True, limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+    else:
+        async def load_page() -> Dict[str, Any]:
+            page_rows = await _select_beyond_cursor(column, value, before_cursor, False, limit + 1)
+            return {"rows": page_rows[:limit], "has_more": len(page_rows) > limit}
+
+        cache_key = _message_page_cache_key(cache_prefix, limit, before)
+        page = await redis_manager.get_or_load(cache_key, load_page, tags=tags, stale_ttl=stale_ttl)
+        rows, has_more = page["rows"], page["has_more"]
+
+    if recent is None and not before_cursor:
+        pending = _get_pending_chat_rows(pending_key)
+        if after_cursor:
+            pending = [row for row in pending if _row_position(row) > floor]
+        if pending:
+            merged = _merge_pending_chat_rows(rows, pending)
+            if after_cursor:
+                rows = merged
+            else:
+                has_more = has_more or len(merged) > limit
+                rows = merged[:limit]
+
+    rows = [_public_chat_row(row) for row in rows]
+    newest_cursor = encode_cursor(rows[0]) if rows else after
+    if after_cursor:
+        next_cursor = None
+    else:
+        next_cursor = encode_cursor(rows[-1]) if rows and has_more else None
+    return {
+        "messages": rows,
+        "next_cursor": next_cursor,
+        "newest_cursor": newest_cursor,
+        "has_more": has_more
+    }
+
+def invalidate_message_caches(user_id: Optional[str] = None, conversation_id: Optional[str] = None) -> None:
+    """Drop cached message pages for a user and/or conversation"""
+    tags = []
+    if conversation_id:
+        tags.append(f"conversation:{conversation_id}")
+    if user_id:
+        tags.extend([f"chat_history:{user_id}", f"bootstrap:{user_id}"])
+    redis_manager.invalidate_tag(*tags)
+
+# Cached /api/bootstrap payload; dropped by any write that changes one of its sections
+BOOTSTRAP_CACHE_PREFIX = "bootstrap:"
+BOOTSTRAP_CACHE_TTL = 60
+
+def bootstrap_cache_tags(user_id: Any) -> List[str]:
+    return [f"user:{user_id}", f"bootstrap:{user_id}"]
+
+def invalidate_bootstrap_snapshot(user_id: Any) -> None:
+    redis_manager.invalidate_tag(f"bootstrap:{user_id}")
+
+def token_balance_cache_tags(user_id: Any) -> List[str]:
+    return [f"user:{user_id}", f"token_balance:{user_id}"]
 
 async def insert_chat_message(user_id: uuid.UUID, message: str, chat_type: str = 'text', conversation_id: Optional[uuid.UUID] = None) -> Dict:
     user_exists = await check_user_exists(user_id)
@@ -62,38 +728,369 @@ async def insert_chat_message(user_id: uuid.UUID, message: str, chat_type: str =
         conversation = await create_conversation(user_id)
         conversation_id = uuid.UUID(conversation['id'])
         
-    response = supabase.table("user_chat_history").insert({
+    row = {
+        "client_id": str(uuid.uuid4()),
         "user_id": str(user_id),
         "conversation_id": str(conversation_id),
         "message": message,
-        "chat_type": chat_type
-    }).execute()
-    return response.data[0] if response.data else {}
+        "chat_type": chat_type,
+        "TIMESTAMP": datetime.now(timezone.utc).isoformat()
+    }
+    try:
+        _enqueue_chat_row(row)
+        _record_conversation_activity_in_index(row)
+        return row
+    except Exception as e:
+        # Fall back to a direct write if the buffer is unavailable
+        logger.error(f"Error buffering chat message, writing directly: {str(e)}")
+        inserted = await _insert_chat_rows([row])
+        await _record_conversation_activity([row])
+        _record_conversation_activity_in_index(row)
+        written = inserted[0] if inserted else {}
+        try:
+            with redis_manager.redis.pipeline() as pipe:
+                _push_recent_message(pipe, row, json.dumps(_public_chat_row(written or row)))
+                pipe.execute()
+        except Exception as e:
+            logger.error(f"Error updating recent messages: {str(e)}")
+            # The lists would otherwise be served without this message
+            _drop_recent_messages([row])
+        return written
+
+def chat_history_cache_tags(user_id: Any) -> List[str]:
+    return [f"chat_history:{user_id}", f"user:{user_id}"]
+
+async def get_chat_history_page(
+    user_id: uuid.UUID,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+) -> Dict[str, Any]:
+    """Keyset-paginated chat history for a user, newest first"""
+    return await _get_message_page(
+        "user_id", str(user_id),
+        f"chat_history:{user_id}",
+        f"{CHAT_PENDING_USER_PREFIX}{user_id}",
+        limit, before, after,
+        tags=chat_history_cache_tags(user_id),
+        stale_ttl=HISTORY_CACHE_STALE_TTL
+    )
 
 async def get_chat_history(user_id: uuid.UUID, limit: int = 50) -> List[Dict]:
-    response = supabase.table("user_chat_history").select("*").eq("user_id", str(user_id)).order("TIMESTAMP", desc=True).limit(limit).execute()
-    return response.data
+    page = await get_chat_history_page(user_id, limit)
+    return page["messages"]
 
 async def insert_video_analysis(user_id: uuid.UUID, upload_file_name: str, analysis: str, video_duration: Optional[str] = None, video_format: Optional[str] = None) -> Dict:
-    response = supabase.table("video_analysis_output").insert({
+    response = await _execute("video_analysis_output.insert", db().table("video_analysis_output").insert({
         "user_id": str(user_id),
         "upload_file_name": upload_file_name,
         "analysis": analysis,
         "video_duration": video_duration,
         "video_format": video_format
-    }).execute()
+    }))
+    # Only once the row is visible, so a reload between the bump and the
+    # insert cannot cache (and tag an ETag to) the history without it
+    redis_manager.invalidate_tag(f"video_history:{user_id}", f"bootstrap:{user_id}")
     return response.data[0] if response.data else {}
 
 async def get_video_analysis_history(user_id: uuid.UUID, limit: int = 10) -> List[Dict]:
-    response = supabase.table("video_analysis_output").select("*").eq("user_id", str(user_id)).order("TIMESTAMP", desc=True).limit(limit).execute()
+    response = await _execute("video_analysis_output.select", db().table("video_analysis_output").select("*").eq("user_id", str(user_id)).order("TIMESTAMP", desc=True).limit(limit))
     return response.data
 
 
+# Per-user conversation index: a sorted set of conversation IDs scored by
+# updated_at plus one small hash per conversation. Writes update it in place;
+# Postgres is only read to build it the first time or after it expires.
+CONVERSATION_INDEX_PREFIX = "conversation_index:"
+CONVERSATION_META_PREFIX = "conversation_meta:"
+CONVERSATION_INDEX_TTL = 86400
+CONVERSATION_COLUMNS = "id, user_id, title, created_at, updated_at"
+
+# Every write bumps the version so a rebuild that raced with it is discarded.
+# Only an index that has been built is touched, so a partial one is never served.
+_UPSERT_CONVERSATION_SCRIPT = """
+redis.call('incr', KEYS[4])
+redis.call('expire', KEYS[4], ARGV[3])
+if redis.call('exists', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[3], unpack(ARGV, 4))
+redis.call('expire', KEYS[3], ARGV[3])
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+def _conversation_index_keys(user_id: str) -> tuple:
+    index_key = f"{CONVERSATION_INDEX_PREFIX}{user_id}"
+    return index_key, f"{index_key}:ready", f"{index_key}:version"
+
+# Denormalized summary kept next to each conversation (see sql/conversation_summaries.sql)
+CONVERSATION_SUMMARY_FIELDS = ("last_message", "message_count", "last_activity")
+CONVERSATION_SNIPPET_CHARS = 120
+
+# KEYS: meta hash, index version; ARGV: snippet, timestamp, ttl
+# Bumps the version like _UPSERT_CONVERSATION_SCRIPT, so a rebuild that read
+# Postgres before this message is discarded
+_RECORD_ACTIVITY_SCRIPT = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('hincrby', KEYS[1], 'message_count', 1)
+redis.call('hset', KEYS[1], 'last_message', ARGV[1], 'last_activity', ARGV[2])
+return 1
+"""
+
+def _message_snippet(message: str) -> str:
+    snippet = " ".join((message or "").split())
+    if len(snippet) <= CONVERSATION_SNIPPET_CHARS:
+        return snippet
+    return snippet[:CONVERSATION_SNIPPET_CHARS - 1].rstrip() + "…"
+
+def _conversation_meta(conversation: Dict) -> Dict[str, str]:
+    meta = {column: str(conversation.get(column) or "") for column in CONVERSATION_COLUMNS.split(", ")}
+    for field in CONVERSATION_SUMMARY_FIELDS:
+        if field in conversation:
+            meta[field] = str(conversation[field] or "")
+    return meta
+
+def _normalize_conversation(conversation: Dict) -> Dict:
+    """Give every conversation the same summary fields whatever they were loaded from"""
+    conversation.pop("summary", None)
+    conversation["message_count"] = int(conversation.get("message_count") or 0)
+    conversation["last_message"] = conversation.get("last_message") or None
+    conversation["last_activity"] = conversation.get("last_activity") or None
+    return conversation
+
+def _apply_conversation_summary(conversation: Dict, pending: List[Dict]) -> Dict:
+    """Flatten the stored summary and fold in messages still in the write buffer"""
+    summary = conversation.get("summary") or {}
+    conversation["message_count"] = int(summary.get("message_count") or 0) + len(pending)
+    conversation["last_message"] = summary.get("last_message")
+    conversation["last_activity"] = summary.get("last_activity")
+    if pending:
+        newest = max(pending, key=_row_position)
+        if _parse_timestamp(newest.get("TIMESTAMP")) >= _parse_timestamp(conversation["last_activity"]):
+            conversation["last_message"] = _message_snippet(newest.get("message"))
+            conversation["last_activity"] = newest.get("TIMESTAMP")
+    return _normalize_conversation(conversation)
+
+def _record_conversation_activity_in_index(row: Dict) -> None:
+    """Update the cached summary of a conversation, if it is in an index"""
+    try:
+        redis_manager.redis.eval(
+            _RECORD_ACTIVITY_SCRIPT, 2,
+            f"{CONVERSATION_META_PREFIX}{row['conversation_id']}",
+            _conversation_index_keys(row["user_id"])[2],
+            _message_snippet(row["message"]), row["TIMESTAMP"], CONVERSATION_INDEX_TTL
+        )
+    except Exception as e:
+        logger.error(f"Error updating conversation summary: {str(e)}")
+        _drop_conversation_index(row.get("user_id"))
+
+async def _record_conversation_activity(rows: List[Dict]) -> None:
+    """Fold written messages into conversations.summary, one RPC per conversation"""
+    by_conversation: Dict[str, List[Dict]] = {}
+    for row in rows:
+        by_conversation.setdefault(row["conversation_id"], []).append(row)
+
+    async def record(conversation_id: str, conversation_rows: List[Dict]):
+        newest = max(conversation_rows, key=_row_position)
+        await _execute("rpc.record_conversation_activity", db().rpc("record_conversation_activity", {
+            "p_conversation_id": conversation_id,
+            "p_message_count": len(conversation_rows),
+            "p_last_message": _message_snippet(newest["message"]),
+            "p_last_activity": newest["TIMESTAMP"]
+        }))
+
+    results = await asyncio.gather(
+        *(record(conversation_id, conversation_rows) for conversation_id, conversation_rows in by_conversation.items()),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error recording conversation activity: {str(result)}")
+
+def _conversation_score(conversation: Dict) -> float:
+    return _parse_timestamp(conversation.get("updated_at")).timestamp()
+
+def _index_conversation(conversation: Dict) -> None:
+    """Insert or update a conversation in its owner's index, if the index is built"""
+    try:
+        index_key, ready_key, version_key = _conversation_index_keys(conversation["user_id"])
+        fields = []
+        for field, value in _conversation_meta(conversation).items():
+            fields.extend([field, value])
+        redis_manager.redis.eval(
+            _UPSERT_CONVERSATION_SCRIPT, 4,
+            index_key, ready_key, f"{CONVERSATION_META_PREFIX}{conversation['id']}", version_key,
+            conversation["id"], _conversation_score(conversation), CONVERSATION_INDEX_TTL, *fields
+        )
+        invalidate_bootstrap_snapshot(conversation["user_id"])
+    except Exception as e:
+        logger.error(f"Error updating conversation index: {str(e)}")
+        _drop_conversation_index(conversation.get("user_id"))
+
+def _unindex_conversation(user_id: str, conversation_id: str) -> None:
+    try:
+        index_key, _, version_key = _conversation_index_keys(user_id)
+        with redis_manager.redis.pipeline() as pipe:
+            pipe.incr(version_key)
+            pipe.expire(version_key, CONVERSATION_INDEX_TTL)
+            pipe.zrem(index_key, conversation_id)
+            pipe.delete(f"{CONVERSATION_META_PREFIX}{conversation_id}")
+            pipe.execute()
+        invalidate_bootstrap_snapshot(user_id)
+    except Exception as e:
+        logger.error(f"Error updating conversation index: {str(e)}")
+        _drop_conversation_index(user_id)
+
+# KEYS: index, ready flag, index version; ARGV: version the window opened at, ttl
+# The ready flag holds the version a build started from, so a build that read
+# Postgres inside the window is dropped; the bump discards one still in flight
+_CLOSE_INDEX_WINDOW_SCRIPT = """
+redis.call('incr', KEYS[3])
+redis.call('expire', KEYS[3], ARGV[2])
+local built = tonumber(redis.call('get', KEYS[2]))
+if built and built >= tonumber(ARGV[1]) then
+    redis.call('del', KEYS[1], KEYS[2])
+end
+return 0
+"""
+
+def _open_conversation_index_window(user_ids: List[str]) -> Dict[str, int]:
+    """Bump each user's index version; returns the versions to close the window with"""
+    try:
+        with redis_manager.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                _, _, version_key = _conversation_index_keys(user_id)
+                pipe.incr(version_key)
+                pipe.expire(version_key, CONVERSATION_INDEX_TTL)
+            results = pipe.execute()
+        return dict(zip(user_ids, results[::2]))
+    except Exception as e:
+        logger.error(f"Error bumping conversation index versions: {str(e)}")
+        # Closing from version 0 drops whatever index is built by then
+        return {user_id: 0 for user_id in user_ids}
+
+def _close_conversation_index_window(user_id: str, version: int) -> None:
+    try:
+        redis_manager.redis.eval(
+            _CLOSE_INDEX_WINDOW_SCRIPT, 3, *_conversation_index_keys(user_id),
+            version, CONVERSATION_INDEX_TTL
+        )
+    except Exception as e:
+        logger.error(f"Error closing conversation index window: {str(e)}")
+        _drop_conversation_index(user_id)
+
+def _drop_conversation_index(user_id: Optional[str]) -> None:
+    """Force the next read to rebuild the index from Postgres"""
+    if not user_id:
+        return
+    try:
+        index_key, ready_key, version_key = _conversation_index_keys(user_id)
+        with redis_manager.redis.pipeline() as pipe:
+            pipe.delete(index_key, ready_key)
+            # Also discards a rebuild that read Postgres before the change
+            pipe.incr(version_key)
+            pipe.expire(version_key, CONVERSATION_INDEX_TTL)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Error dropping conversation index: {str(e)}")
+
+def _read_conversation_index(user_id: str) -> Optional[List[Dict]]:
+    """Conversations from the index, newest first, or None if it needs rebuilding"""
+    index_key, ready_key, _ = _conversation_index_keys(user_id)
+    if not redis_manager.redis.exists(ready_key):
+        return None
+    conversation_ids = redis_manager.redis.zrevrange(index_key, 0, -1)
+    with redis_manager.redis.pipeline(transaction=False) as pipe:
+        for conversation_id in conversation_ids:
+            meta_key = f"{CONVERSATION_META_PREFIX}{conversation_id.decode('utf-8')}"
+            pipe.hgetall(meta_key)
+            pipe.expire(meta_key, CONVERSATION_INDEX_TTL)
+        pipe.expire(index_key, CONVERSATION_INDEX_TTL)
+        pipe.expire(ready_key, CONVERSATION_INDEX_TTL)
+        results = pipe.execute()
+
+    conversations = []
+    for meta in results[0:len(conversation_ids) * 2:2]:
+        if not meta:
+            # A hash expired on its own; the index is incomplete
+            return None
+        conversations.append(_normalize_conversation({
+            field.decode('utf-8'): value.decode('utf-8') or None
+            for field, value in meta.items()
+        }))
+    return conversations
+
+def _get_conversation_index_version(user_id: str) -> Optional[bytes]:
+    _, _, version_key = _conversation_index_keys(user_id)
+    try:
+        return redis_manager.redis.get(version_key)
+    except Exception as e:
+        logger.error(f"Error reading conversation index version: {str(e)}")
+        return None
+
+def _build_conversation_index(user_id: str, conversations: List[Dict], version: Optional[bytes]) -> None:
+    """Store a freshly loaded index unless a write landed since `version` was read"""
+    index_key, ready_key, version_key = _conversation_index_keys(user_id)
+    with redis_manager.redis.pipeline() as pipe:
+        try:
+            pipe.watch(version_key)
+            if pipe.get(version_key) != version:
+                return
+            pipe.multi()
+        except WatchError:
+            return
+        pipe.delete(index_key)
+        for conversation in conversations:
+            meta_key = f"{CONVERSATION_META_PREFIX}{conversation['id']}"
+            pipe.delete(meta_key)
+            pipe.hset(meta_key, mapping=_conversation_meta(conversation))
+            pipe.expire(meta_key, CONVERSATION_INDEX_TTL)
+        if conversations:
+            pipe.zadd(index_key, {
+                conversation["id"]: _conversation_score(conversation)
+                for conversation in conversations
+            })
+            pipe.expire(index_key, CONVERSATION_INDEX_TTL)
+        pipe.set(ready_key, int(version or 0), ex=CONVERSATION_INDEX_TTL)
+        try:
+            pipe.execute()
+        except WatchError:
+            pass
+
 async def get_user_conversations(user_id: uuid.UUID) -> List[Dict]:
-    """Get all conversations for a user"""
+    """Get all conversations for a user, most recently updated first"""
     try:
-        response = supabase.table("conversations").select("*").eq("user_id", str(user_id)).is_("deleted_at", "null").order("created_at", desc=True).execute()
-        return response.data
+        try:
+            conversations = _read_conversation_index(str(user_id))
+            if conversations is not None:
+                return conversations
+        except Exception as e:
+            logger.error(f"Error reading conversation index: {str(e)}")
+
+        version = _get_conversation_index_version(str(user_id))
+        response = await _execute("conversations.select", db().table("conversations").select(f"{CONVERSATION_COLUMNS}, summary").eq("user_id", str(user_id)).is_("deleted_at", "null").order("updated_at", desc=True))
+        conversations = response.data or []
+        pending = {}
+        try:
+            with redis_manager.redis.pipeline(transaction=False) as pipe:
+                for conversation in conversations:
+                    pipe.lrange(f"{CHAT_PENDING_CONVERSATION_PREFIX}{conversation['id']}", 0, -1)
+                for conversation, raw_rows in zip(conversations, pipe.execute()):
+                    pending[conversation["id"]] = [json.loads(raw) for raw in raw_rows]
+        except Exception as e:
+            logger.error(f"Error reading pending chat messages: {str(e)}")
+        for conversation in conversations:
+            _apply_conversation_summary(conversation, pending.get(conversation["id"], []))
+        try:
+            _build_conversation_index(str(user_id), conversations, version)
+        except Exception as e:
+            logger.error(f"Error building conversation index: {str(e)}")
+        return conversations
     except Exception as e:
         logger.error(f"Error getting conversations: {str(e)}")
         return []
@@ -101,35 +1098,40 @@ async def get_user_conversations(user_id: uuid.UUID) -> List[Dict]:
 async def create_conversation(user_id: uuid.UUID, title: str = "New Conversation") -> Dict:
     """Create a new conversation for a user"""
     try:
-        response = supabase.table("conversations").insert({
+        response = await _execute("conversations.insert", db().table("conversations").insert({
             "user_id": str(user_id),
             "title": title,
             "created_at": datetime.now(timezone.utc).isoformat(),
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).execute()
-        return response.data[0] if response.data else {}
+        }))
+        conversation = response.data[0] if response.data else {}
+        if conversation:
+            _index_conversation(_apply_conversation_summary(dict(conversation), []))
+        return conversation
     except Exception as e:
         logger.error(f"Error creating conversation: {str(e)}")
         raise ValueError(f"Failed to create conversation: {str(e)}")
 
+async def get_conversation_messages_page(
+    conversation_id: uuid.UUID,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+) -> Dict[str, Any]:
+    """Keyset-paginated messages in a conversation, newest first"""
+    return await _get_message_page(
+        "conversation_id", str(conversation_id),
+        f"conversation:{conversation_id}",
+        f"{CHAT_PENDING_CONVERSATION_PREFIX}{conversation_id}",
+        limit, before, after,
+        tags=[f"conversation:{conversation_id}"]
+    )
+
 async def get_conversation_messages(conversation_id: uuid.UUID, limit: int = 50) -> List[Dict]:
-    """Get all messages in a conversation with caching"""
+    """Get the newest messages in a conversation with caching"""
     try:
-        cache_key = f"conversation:{str(conversation_id)}"
-        
-        # Try to get from cache first
-        cached_messages = redis_manager.get_cache(cache_key)
-        if cached_messages:
-            return cached_messages
-            
-        # If not in cache, get from database
-        response = supabase.table("user_chat_history").select("*").eq("conversation_id", str(conversation_id)).order("TIMESTAMP", desc=True).limit(limit).execute()
-        
-        if response.data:
-            # Cache the results for 5 minutes
-            redis_manager.set_cache(cache_key, response.data)
-            return response.data
-        return []
+        page = await get_conversation_messages_page(conversation_id, limit)
+        return page["messages"]
     except Exception as e:
         logger.error(f"Error getting conversation messages: {str(e)}")
         return []
@@ -138,7 +1140,7 @@ async def update_conversation_title(conversation_id: uuid.UUID, title: str) -> D
     """Update a conversation's title"""
     try:
         # First check if conversation exists and is not deleted
-        check_response = supabase.table("conversations").select("*").eq("id", str(conversation_id)).is_("deleted_at", "null").execute()
+        check_response = await _execute("conversations.select", db().table("conversations").select("*").eq("id", str(conversation_id)).is_("deleted_at", "null"))
         if not check_response.data:
             logger.error(f"Conversation {conversation_id} not found or has been deleted")
             raise ValueError(f"Conversation {conversation_id} not found or has been deleted")
@@ -149,15 +1151,16 @@ async def update_conversation_title(conversation_id: uuid.UUID, title: str) -> D
             raise ValueError("Title cannot be empty")
 
         # Update the conversation
-        response = supabase.table("conversations").update({
+        response = await _execute("conversations.update", db().table("conversations").update({
             "title": title.strip(),
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("id", str(conversation_id)).execute()
+        }).eq("id", str(conversation_id)))
 
         if not response.data:
             logger.error(f"Failed to update conversation {conversation_id}")
             raise ValueError(f"Failed to update conversation {conversation_id}")
 
+        _index_conversation(response.data[0])
         logger.info(f"Successfully updated conversation {conversation_id} with title '{title}'")
         return response.data[0]
     except ValueError as e:
@@ -171,21 +1174,22 @@ async def delete_conversation(conversation_id: uuid.UUID) -> bool:
     """Soft delete a conversation"""
     try:
         # First check if conversation exists and is not already deleted
-        check_response = supabase.table("conversations").select("*").eq("id", str(conversation_id)).is_("deleted_at", "null").execute()
+        check_response = await _execute("conversations.select", db().table("conversations").select("*").eq("id", str(conversation_id)).is_("deleted_at", "null"))
         if not check_response.data:
             logger.error(f"Conversation {conversation_id} not found or has been already deleted")
             raise ValueError(f"Conversation {conversation_id} not found or has been already deleted")
 
         # Perform soft delete
-        response = supabase.table("conversations").update({
+        response = await _execute("conversations.update", db().table("conversations").update({
             "deleted_at": datetime.now(timezone.utc).isoformat(),
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("id", str(conversation_id)).execute()
+        }).eq("id", str(conversation_id)))
 
         if not response.data:
             logger.error(f"Failed to delete conversation {conversation_id}")
             raise ValueError(f"Failed to delete conversation {conversation_id}")
 
+        _unindex_conversation(check_response.data[0]["user_id"], str(conversation_id))
         logger.info(f"Successfully deleted conversation {conversation_id}")
         return True
     except ValueError as e:
@@ -199,76 +1203,158 @@ async def delete_conversation(conversation_id: uuid.UUID) -> bool:
 async def get_user_token_balance(user_id: uuid.UUID) -> int:
     """Get the current token balance for a user with Redis caching"""
     try:
-        # Try to get from cache first
-        cache_key = f"token_balance:{str(user_id)}"
-        cached_balance = redis_manager.get_cache(cache_key)
-        
-        if cached_balance is not None:
-            logger.debug(f"Returning cached token balance for user {user_id}")
-            return cached_balance
-
-        # If not in cache, get from database
-        response = supabase.table("user_tokens").select("tokens").eq("user_id", str(user_id)).execute()
-        if not response.data:
-            # Initialize tokens if user doesn't have any
-            await initialize_user_tokens(user_id)
-            balance = 0
-        else:
-            balance = response.data[0]["tokens"]
+        async def load_balance() -> int:
+            response = await _execute("user_tokens.select", db().table("user_tokens").select("tokens").eq("user_id", str(user_id)))
+            if not response.data:
+                # Initialize tokens if user doesn't have any
+                await initialize_user_tokens(user_id)
+                return 0
+            return response.data[0]["tokens"]
 
-        # Cache the result for 30 seconds
-        redis_manager.set_cache(cache_key, balance, ttl=30)
-        return balance
+        # Cached for 30 seconds; concurrent misses share one query
+        cache_key = f"token_balance:{str(user_id)}"
+        return await redis_manager.get_or_load(cache_key, load_balance, ttl=30, tags=token_balance_cache_tags(user_id))
     except Exception as e:
         logger.error(f"Error getting user token balance: {str(e)}")
         raise ValueError(f"Failed to get token balance: {str(e)}")
 
-async def update_token_usage(user_id: uuid.UUID, tokens_used: int) -> None:
-    """Update token usage for a user with cache invalidation"""
+async def update_token_usage(user_id: uuid.UUID, tokens_used: int,
+                             reservation_id: Optional[str] = None) -> int:
+    """
+    Debit tokens and record usage atomically; returns the new balance.
+
+    With a reservation_id the debit is applied at most once, so it is safe to retry.
+    """
     try:
-        # Record token usage
-        supabase.table("token_usage").insert({
-            "user_id": str(user_id),
-            "tokens_used": tokens_used,
-        }).execute()
+        # debit_user_tokens (sql/debit_user_tokens.sql) updates user_tokens and
+        # inserts into token_usage in one transaction under the row lock
+        params = {"p_user_id": str(user_id), "p_tokens": tokens_used}
+        if reservation_id:
+            params["p_reservation_id"] = reservation_id
+        response = await _execute("rpc.debit_user_tokens", db().rpc("debit_user_tokens", params))
+        if not response.data:
+            # No balance row yet; create it and debit again
+            await initialize_user_tokens(user_id)
+            response = await _execute("rpc.debit_user_tokens", db().rpc("debit_user_tokens", params))
+        if not response.data:
+            raise ValueError(f"No token balance found for user {user_id}")
 
-        # Update user's token balance
-        cache_key = f"token_balance:{str(user_id)}"
-        current_balance = await get_user_token_balance(user_id)
-        new_balance = max(0, current_balance - tokens_used)
-        
-        # Update database
-        supabase.table("user_tokens").update({
-            "tokens": new_balance,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("user_id", str(user_id)).execute()
+        new_balance = response.data[0]["tokens"]
         
-        # Update cache with new balance
-        redis_manager.set_cache(cache_key, new_balance, ttl=30)
-        
-        # Invalidate any related caches
-        subscription_cache_key = f"subscription:{str(user_id)}"
-        redis_manager.invalidate_cache(subscription_cache_key)
+        # Bump the generation rather than overwrite the cached balance, so a
+        # load already in flight cannot store the old one and ETags change
+        redis_manager.invalidate_tag(f"token_balance:{user_id}", f"bootstrap:{user_id}")
+
+        return new_balance
         
     except Exception as e:
         logger.error(f"Error updating token usage: {str(e)}")
         raise ValueError(f"Failed to update token usage: {str(e)}")
 
+# Subscription tiers are reference data: the whole table is held in memory as an
+# immutable snapshot, replaced wholesale on refresh or explicit invalidation
+SUBSCRIPTION_TIER_REFRESH_INTERVAL = int(os.environ.get("SUBSCRIPTION_TIER_REFRESH_SECONDS", "300"))
+SUBSCRIPTION_TIER_MISS_REFRESH_INTERVAL = 30
+
+class SubscriptionTierCatalog:
+    """Read-only view of subscription_tiers keyed by id and by tier_name"""
+
+    def __init__(self, tiers: List[Dict]):
+        frozen = [MappingProxyType(dict(tier)) for tier in tiers]
+        self.by_id = MappingProxyType({tier["id"]: tier for tier in frozen})
+        self.by_name = MappingProxyType({tier["tier_name"]: tier for tier in frozen})
+        self.loaded_at = time.monotonic()
+
+    def get(self, tier_id: int) -> Optional[Dict]:
+        tier = self.by_id.get(tier_id)
+        return dict(tier) if tier else None
+
+    def get_by_name(self, tier_name: str) -> Optional[Dict]:
+        tier = self.by_name.get(tier_name)
+        return dict(tier) if tier else None
+
+    def summary(self, tier_id: int) -> Optional[Dict]:
+        """The tier_name/tokens/price subset the old PostgREST joins returned"""
+        tier = self.by_id.get(tier_id)
+        if not tier:
+            return None
+        return {"tier_name": tier["tier_name"], "tokens": tier["tokens"], "price": tier["price"]}
+
+_tier_catalog: Optional[SubscriptionTierCatalog] = None
+_tier_catalog_lock: Optional[asyncio.Lock] = None
+_tier_catalog_last_miss_refresh = 0.0
+
+async def load_subscription_tiers() -> SubscriptionTierCatalog:
+    """Load subscription_tiers from Postgres and swap in a new catalog"""
+    global _tier_catalog, _tier_catalog_lock
+    if _tier_catalog_lock is None:
+        _tier_catalog_lock = asyncio.Lock()
+    async with _tier_catalog_lock:
+        response = await _execute("subscription_tiers.select", db().table("subscription_tiers").select("*"))
+        _tier_catalog = SubscriptionTierCatalog(response.data or [])
+        logger.info(f"Loaded {len(_tier_catalog.by_id)} subscription tiers")
+        return _tier_catalog
+
+def invalidate_subscription_tiers() -> None:
+    """Drop the in-memory catalog; the next lookup reloads it"""
+    global _tier_catalog
+    _tier_catalog = None
+
+async def get_subscription_tier_catalog() -> SubscriptionTierCatalog:
+    catalog = _tier_catalog
+    if catalog is None or time.monotonic() - catalog.loaded_at > SUBSCRIPTION_TIER_REFRESH_INTERVAL * 2:
+        # Not loaded yet, invalidated, or the refresher has stopped running
+        catalog = await load_subscription_tiers()
+    return catalog
+
+async def _refresh_subscription_tiers_on_miss() -> Optional[SubscriptionTierCatalog]:
+    """Reload after a lookup miss (e.g. a tier added since the last refresh), rate-limited"""
+    global _tier_catalog_last_miss_refresh
+    now = time.monotonic()
+    if now - _tier_catalog_last_miss_refresh < SUBSCRIPTION_TIER_MISS_REFRESH_INTERVAL:
+        return None
+    _tier_catalog_last_miss_refresh = now
+    return await load_subscription_tiers()
+
+async def run_subscription_tier_refresher() -> None:
+    while True:
+        await asyncio.sleep(SUBSCRIPTION_TIER_REFRESH_INTERVAL)
+        try:
+            await load_subscription_tiers()
+        except Exception as e:
+            # Keep serving the previous snapshot
+            logger.error(f"Error refreshing subscription tiers: {str(e)}")
+
+async def _lookup_tier(tier_id: Optional[int] = None, tier_name: Optional[str] = None) -> Optional[Dict]:
+    catalog = await get_subscription_tier_catalog()
+    tier = catalog.get(tier_id) if tier_name is None else catalog.get_by_name(tier_name)
+    if tier is None:
+        catalog = await _refresh_subscription_tiers_on_miss()
+        if catalog:
+            tier = catalog.get(tier_id) if tier_name is None else catalog.get_by_name(tier_name)
+    return tier
+
+def _attach_tier_summary(row: Dict, catalog: SubscriptionTierCatalog) -> Dict:
+    if row:
+        row["subscription_tiers"] = catalog.summary(row.get("subscription_tier_id"))
+    return row
+
 async def get_user_subscription_tier(user_id: uuid.UUID) -> Dict:
     """Get the subscription tier details for a user"""
     try:
-        response = supabase.table("user_tokens").select(
-            "subscription_tier_id, subscription_tiers(tier_name, tokens, price)"
-        ).eq("user_id", str(user_id)).execute()
+        response = await _execute("user_tokens.select", db().table("user_tokens").select(
+            "subscription_tier_id"
+        ).eq("user_id", str(user_id)))
         
         if not response.data:
             # Initialize with default tier if not found
             await initialize_user_tokens(user_id)
-            response = supabase.table("user_tokens").select(
-                "subscription_tier_id, subscription_tiers(tier_name, tokens, price)"
-            ).eq("user_id", str(user_id)).execute()
+            response = await _execute("user_tokens.select", db().table("user_tokens").select(
+                "subscription_tier_id"
+            ).eq("user_id", str(user_id)))
             
-        return response.data[0] if response.data else {}
+        row = response.data[0] if response.data else {}
+        return _attach_tier_summary(row, await get_subscription_tier_catalog())
     except Exception as e:
         logger.error(f"Error getting user subscription tier: {str(e)}")
         raise ValueError(f"Failed to get subscription tier: {str(e)}")
@@ -277,24 +1363,23 @@ async def initialize_user_tokens(user_id: uuid.UUID, tier_id: int = 1) -> None:
     """Initialize tokens for a new user with default subscription tier"""
     try:
         # Get the token amount for the tier
-        tier_response = supabase.table("subscription_tiers").select("tokens").eq("id", tier_id).execute()
-        if not tier_response.data:
+        tier = await _lookup_tier(tier_id=tier_id)
+        if not tier:
             raise ValueError(f"Subscription tier {tier_id} not found")
             
-        initial_tokens = tier_response.data[0]["tokens"]
+        initial_tokens = tier["tokens"]
         
         # Create user_tokens entry
-        response = supabase.table("user_tokens").insert({
+        response = await _execute("user_tokens.insert", db().table("user_tokens").insert({
             "user_id": str(user_id),
             "subscription_tier_id": tier_id,
             "tokens": initial_tokens,
             "created_at": datetime.now(timezone.utc).isoformat(),
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).execute()
+        }))
 
-        # Ensure cache is updated
-        cache_key = f"token_balance:{str(user_id)}"
-        redis_manager.set_cache(cache_key, initial_tokens, ttl=30)
+        # Drop the cached balance (0 while the row was missing)
+        redis_manager.invalidate_tag(f"token_balance:{user_id}", f"bootstrap:{user_id}")
     except Exception as e:
         logger.error(f"Error initializing user tokens: {str(e)}")
         raise ValueError(f"Failed to initialize user tokens: {str(e)}")
@@ -303,13 +1388,13 @@ async def initialize_user_tokens(user_id: uuid.UUID, tier_id: int = 1) -> None:
 async def create_user_subscription(user_id: uuid.UUID, tier_id: int, stripe_customer_id: str = None, stripe_subscription_id: str = None) -> Dict:
     """Create a new subscription for a user"""
     try:
-        response = supabase.table("user_subscriptions").insert({
+        response = await _execute("user_subscriptions.insert", db().table("user_subscriptions").insert({
             "user_id": str(user_id),
             "subscription_tier_id": tier_id,
             "stripe_customer_id": stripe_customer_id,
             "stripe_subscription_id": stripe_subscription_id,
             "status": "active" if stripe_subscription_id else "incomplete"
-        }).execute()
+        }))
         return response.data[0] if response.data else {}
     except Exception as e:
         logger.error(f"Error creating user subscription: {str(e)}")
@@ -318,11 +1403,12 @@ async def create_user_subscription(user_id: uuid.UUID, tier_id: int, stripe_cust
 async def get_user_subscription(user_id: uuid.UUID) -> Dict:
     """Get the current subscription for a user"""
     try:
-        response = supabase.table("user_subscriptions").select(
-            "*, subscription_tiers(tier_name, tokens, price)"
-        ).eq("user_id", str(user_id)).is_("deleted_at", "null").execute()
+        response = await _execute("user_subscriptions.select", db().table("user_subscriptions").select(
+            "*"
+        ).eq("user_id", str(user_id)).is_("deleted_at", "null"))
         
-        return response.data[0] if response.data else {}
+        row = response.data[0] if response.data else {}
+        return _attach_tier_summary(row, await get_subscription_tier_catalog())
     except Exception as e:
         logger.error(f"Error getting user subscription: {str(e)}")
         raise ValueError(f"Failed to get subscription: {str(e)}")
@@ -330,7 +1416,7 @@ async def get_user_subscription(user_id: uuid.UUID) -> Dict:
 async def get_subscription_by_stripe_id(stripe_subscription_id: str) -> Dict:
     """Get subscription details by Stripe subscription ID"""
     try:
-        response = supabase.table("user_subscriptions").select("*").eq("stripe_subscription_id", stripe_subscription_id).execute()
+        response = await _execute("user_subscriptions.select", db().table("user_subscriptions").select("*").eq("stripe_subscription_id", stripe_subscription_id))
         return response.data[0] if response.data else {}
     except Exception as e:
         logger.error(f"Error getting subscription by Stripe ID: {str(e)}")
@@ -346,7 +1432,7 @@ async def update_subscription_status(subscription_id: str, status: str, stripe_c
         if stripe_customer_id:
             update_data["stripe_customer_id"] = stripe_customer_id
             
-        response = supabase.table("user_subscriptions").update(update_data).eq("stripe_subscription_id", subscription_id).execute()
+        response = await _execute("user_subscriptions.update", db().table("user_subscriptions").update(update_data).eq("stripe_subscription_id", subscription_id))
         
         return response.data[0] if response.data else {}
     except Exception as e:
@@ -356,16 +1442,14 @@ async def update_subscription_status(subscription_id: str, status: str, stripe_c
 async def get_subscription_tier(tier_id: int) -> Dict:
     """Get subscription tier details"""
     try:
-        response = supabase.table("subscription_tiers").select("*").eq("id", tier_id).execute()
-        return response.data[0] if response.data else {}
+        return await _lookup_tier(tier_id=tier_id) or {}
     except Exception as e:
         logger.error(f"Error getting subscription tier: {str(e)}")
         raise ValueError(f"Failed to get subscription tier: {str(e)}")
 async def get_subscription_tier_by_name(tier_name: str) -> Dict:
     """Get subscription tier details by name"""
     try:
-        response = supabase.table("subscription_tiers").select("*").eq("tier_name", tier_name).execute()
-        return response.data[0] if response.data else {}
+        return await _lookup_tier(tier_name=tier_name) or {}
     except Exception as e:
         logger.error(f"Error getting subscription tier by name: {str(e)}")
         raise ValueError(f"Failed to get subscription tier: {str(e)}")
@@ -373,17 +1457,18 @@ async def update_user_subscription_tier(user_id: str, tier_name: str) -> Dict:
     """Update user's subscription tier"""
     try:
         # Get tier ID from tier name
-        tier_response = supabase.table("subscription_tiers").select("id").eq("tier_name", tier_name).execute()
-        if not tier_response.data:
+        tier = await _lookup_tier(tier_name=tier_name)
+        if not tier:
             raise ValueError(f"Tier {tier_name} not found")
             
-        tier_id = tier_response.data[0]['id']
+        tier_id = tier['id']
         
         # Update user's subscription tier
-        response = supabase.table("user_tokens").update({
+        response = await _execute("user_tokens.update", db().table("user_tokens").update({
             "subscription_tier_id": tier_id,
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("user_id", user_id).execute()
+        }).eq("user_id", user_id))
+        invalidate_bootstrap_snapshot(user_id)
         
         return response.data[0] if response.data else {}
     except Exception as e:
@@ -394,14 +1479,13 @@ async def update_user_subscription_tier(user_id: str, tier_name: str) -> Dict:
 async def update_user_token_balance(user_id: uuid.UUID, tokens: int) -> Dict:
     """Update user's token balance"""
     try:
-        response = supabase.table("user_tokens").update({
+        response = await _execute("user_tokens.update", db().table("user_tokens").update({
             "tokens": tokens,
             "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("user_id", str(user_id)).execute()
+        }).eq("user_id", str(user_id)))
         
         # Invalidate token balance cache
-        cache_key = f"token_balance:{str(user_id)}"
-        redis_manager.invalidate_cache(cache_key)
+        redis_manager.invalidate_tag(f"token_balance:{user_id}", f"bootstrap:{user_id}")
         
         return response.data[0] if response.data else {}
     except Exception as e:
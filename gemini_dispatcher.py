@@ -0,0 +1,244 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Default budgets, overridable through the environment
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+
+# Rough characters-per-token ratio used when the real count is not known yet
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for budgeting a prompt before it is sent"""
+    if not text:
+        return 1
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check whether an exception is a 429/503 from the Gemini API"""
+    code = getattr(error, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    code = getattr(code, "value", code)
+    if code in (429, 503):
+        return True
+    message = str(error).lower()
+    return (
+        "429" in message or
+        "503" in message or
+        "quota" in message or
+        "resource exhausted" in message or
+        "resource_exhausted" in message or
+        "unavailable" in message
+    )
+
+class TokenBucket:
+    """Token bucket refilled continuously at capacity per minute"""
+
+    def __init__(self, capacity: int):
+        self.capacity = float(max(1, capacity))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self, rate_scale: float):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        refill_rate = self.capacity / 60.0 * rate_scale
+        self.tokens = min(self.capacity, self.tokens + elapsed * refill_rate)
+
+    def time_until_available(self, amount: float, rate_scale: float) -> float:
+        """Seconds until `amount` tokens can be taken (0 if available now)"""
+        self._refill(rate_scale)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        refill_rate = self.capacity / 60.0 * rate_scale
+        return (amount - self.tokens) / refill_rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """Debit (positive) or credit (negative) after the real usage is known"""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class GeminiDispatcher:
+    """
+    Central gateway for blocking Gemini SDK calls.
+
+    Enforces requests-per-minute and tokens-per-minute budgets, caps the number
+    of in-flight calls and backs off adaptively when the API answers 429/503.
+    Callers wait in FIFO order for capacity instead of failing.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="gemini"
+        )
+        # Files API calls (upload/get) are not billed against the generation
+        # quota, so they run on their own pool and skip the token buckets
+        self.file_executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix="gemini-files"
+        )
+
+        # Created lazily so the dispatcher can be built outside a running loop
+        self._admission_lock: Optional[asyncio.Lock] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        # Adaptive backoff (AIMD on the refill rate plus a global pause)
+        self.rate_scale = 1.0
+        self.min_rate_scale = 0.1
+        self.rate_recovery_step = 0.05
+        self.base_backoff = 1.0
+        self.max_backoff = 60.0
+        self.current_backoff = 0.0
+        self.paused_until = 0.0
+        self.max_retries = 5
+
+        # Metrics
+        self.in_flight = 0
+        self.queued = 0
+        self.total_requests = 0
+        self.total_throttled = 0
+        self.total_failed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.last_wait_time = 0.0
+
+    def _get_admission_lock(self) -> asyncio.Lock:
+        if self._admission_lock is None:
+            self._admission_lock = asyncio.Lock()
+        return self._admission_lock
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _wait_for_budget(self, estimated_tokens: int):
+        """Block until the rate budgets and any active backoff allow a call"""
+        # The lock keeps admission FIFO so large requests are not starved
+        async with self._get_admission_lock():
+            while True:
+                pause = self.paused_until - time.monotonic()
+                request_wait = self.request_bucket.time_until_available(1, self.rate_scale)
+                token_wait = self.token_bucket.time_until_available(estimated_tokens, self.rate_scale)
+                wait = max(pause, request_wait, token_wait)
+                if wait <= 0:
+                    self.request_bucket.take(1)
+                    self.token_bucket.take(estimated_tokens)
+                    return
+                await asyncio.sleep(wait)
+
+    def _record_throttle(self):
+        self.total_throttled += 1
+        self.rate_scale = max(self.min_rate_scale, self.rate_scale / 2)
+        if self.current_backoff:
+            self.current_backoff = min(self.max_backoff, self.current_backoff * 2)
+        else:
+            self.current_backoff = self.base_backoff
+        delay = self.current_backoff + random.uniform(0, self.current_backoff / 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.warning(
+            f"Gemini throttled, backing off {delay:.2f}s "
+            f"(rate scale {self.rate_scale:.2f})"
+        )
+
+    def _record_success(self):
+        self.rate_scale = min(1.0, self.rate_scale + self.rate_recovery_step)
+        self.current_backoff = self.current_backoff / 2 if self.current_backoff > self.base_backoff else 0.0
+
+    def _reconcile_tokens(self, result: Any, estimated_tokens: int):
+        """Correct the token bucket with the usage reported by the API"""
+        usage = getattr(result, "usage_metadata", None)
+        actual = getattr(usage, "total_token_count", None) if usage else None
+        if isinstance(actual, int) and actual > 0:
+            self.token_bucket.adjust(actual - estimated_tokens)
+
+    async def submit(self, func: Callable, *args, estimated_tokens: int = 1, **kwargs) -> Any:
+        """Run a blocking Gemini call under the rate budgets, retrying on 429/503"""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            enqueued_at = time.monotonic()
+            self.queued += 1
+            try:
+                await self._wait_for_budget(estimated_tokens)
+                await self._get_semaphore().acquire()
+            finally:
+                self.queued -= 1
+
+            waited = time.monotonic() - enqueued_at
+            self.last_wait_time = waited
+            self.total_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.total_requests += 1
+            self.in_flight += 1
+            try:
+                result = await loop.run_in_executor(
+                    self.executor,
+                    lambda: func(*args, **kwargs)
+                )
+                self._record_success()
+                self._reconcile_tokens(result, estimated_tokens)
+                return result
+            except Exception as e:
+                if is_throttling_error(e) and attempt < self.max_retries:
+                    attempt += 1
+                    self._record_throttle()
+                    continue
+                self.total_failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                self._get_semaphore().release()
+
+    async def run_file_operation(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking Files API call off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.file_executor,
+            lambda: func(*args, **kwargs)
+        )
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "saturation": round(self.in_flight / self.max_concurrency, 3) if self.max_concurrency else 0,
+            "requests_per_minute": int(self.request_bucket.capacity),
+            "tokens_per_minute": int(self.token_bucket.capacity),
+            "rate_scale": round(self.rate_scale, 3),
+            "backoff_seconds": round(max(0.0, self.paused_until - time.monotonic()), 3),
+            "total_requests": self.total_requests,
+            "total_throttled": self.total_throttled,
+            "total_failed": self.total_failed,
+            "wait_time": {
+                "last_ms": round(self.last_wait_time * 1000, 2),
+                "max_ms": round(self.max_wait_time * 1000, 2),
+                "avg_ms": round(self.total_wait_time / self.total_requests * 1000, 2) if self.total_requests else 0
+            }
+        }
@@ -1,14 +1,22 @@
 import redis
 from redis.connection import ConnectionPool
 from redis.exceptions import ConnectionError, TimeoutError
+import os
+import math
 import time
+import uuid
+import bisect
+import fnmatch
 import logging
+import threading
 import json
-from typing import Optional, Any, Dict, List, Union, Tuple
+from typing import Optional, Any, Awaitable, Callable, Dict, List, Union, Tuple
 from datetime import datetime, timedelta
 import random
 from enum import Enum
 import asyncio
+from cachetools import TTLCache
+from cache_serializer import CacheCodec, get_serializer, is_tagged, decode as decode_tagged
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -66,6 +74,55 @@ class RedisManager:
         self.rate_limit_ttl = 60
         self.result_ttl = 86400
         
+        # Users known to exist in the users table: in-process TTL set backed by
+        # a Redis sorted set scored by expiry time
+        self.verified_users_key = "verified_users"
+        self.verified_user_ttl = 3600
+        self.local_verified_user_ttl = 300
+        self.local_verified_users = TTLCache(maxsize=100000, ttl=self.local_verified_user_ttl)
+        
+        # In-process LRU tier in front of the Redis cache. Entries live for at
+        # most local_cache_ttl seconds; sets and invalidations on any node are
+        # broadcast over pub/sub so every worker drops its copy immediately.
+        self.local_cache_ttl = float(os.environ.get("LOCAL_CACHE_TTL", "5"))
+        self.local_cache = TTLCache(
+            maxsize=int(os.environ.get("LOCAL_CACHE_MAX_ENTRIES", "10000")),
+            ttl=self.local_cache_ttl
+        )
+        self.local_cache_lock = threading.Lock()
+        self.node_id = uuid.uuid4().hex
+        self.invalidation_channel = "cache_invalidations"
+        # Each tag (e.g. "conversation:<id>") is a generation counter embedded
+        # in the keys stored under it, so invalidating a tag is one INCR and
+        # the old entries expire by TTL. Counters outlive the entries under them.
+        self.cache_generation_prefix = "cache_gen:"
+        self.cache_generation_ttl = 86400
+        self.local_generations = TTLCache(
+            maxsize=int(os.environ.get("LOCAL_CACHE_MAX_ENTRIES", "10000")),
+            ttl=self.local_cache_ttl
+        )
+        
+        # Stampede protection for get_or_load: one loader per key per process,
+        # and a short Redis lock so only one process loads at a time
+        self.cache_lock_prefix = "cache_lock:"
+        self.cache_lock_ms = 5000
+        self.cache_lock_poll_interval = 0.05
+        self.cache_early_refresh_beta = 1.0
+        self._inflight_loads: Dict[str, asyncio.Future] = {}
+        self._background_refreshes: Dict[str, asyncio.Task] = {}
+        
+        # Per key family ("chat_history", "token_balance", ...) counters and
+        # get/set latency histograms, reported by get_cache_metrics
+        self.cache_stats: Dict[str, Dict[str, Any]] = {}
+        
+        # Cache and session values are written as version-tagged, optionally
+        # compressed payloads. CACHE_SERIALIZER=legacy keeps writing plain JSON
+        # while older nodes that cannot read tagged values are rolled out.
+        serializer_name = os.environ.get("CACHE_SERIALIZER")
+        self.codec = None if serializer_name == "legacy" else CacheCodec(get_serializer(serializer_name))
+        self._invalidation_pubsub = None
+        self._invalidation_thread = None
+        
         self.rate_limit_requests = 100
         self.rate_limit_window = 60
         
@@ -118,8 +175,10 @@ class RedisManager:
                 logger.warning(f"Redis operation failed, retrying in {delay:.2f}s. Error: {str(e)}")
                 time.sleep(delay)
 
-    def _serialize_value(self, value: Any) -> str:
+    def _serialize_value(self, value: Any) -> Union[str, bytes]:
         try:
+            if self.codec is not None:
+                return self.codec.encode(value)
             if isinstance(value, (dict, list)):
                 return json.dumps(value)
             elif isinstance(value, (int, float, bool)):
@@ -135,6 +194,9 @@ class RedisManager:
         if value is None:
             return None
         try:
+            if is_tagged(value):
+                return decode_tagged(value)
+            # Untagged values predate the codec: plain JSON or text
             str_value = value.decode('utf-8')
             if default_type == bool:
                 return str_value.lower() == "true"
@@ -261,15 +323,10 @@ class RedisManager:
                                     stats["sessions"] += 1
                                     
                                     if user_id:
-                                        # Clean up user's chat history cache
-                                        chat_history_key = f"chat_history:{user_id}"
-                                        self._retry_operation(self.redis.delete, chat_history_key)
-                                        stats["caches"] += 1
-                                        
-                                        # Clean up user's video analysis cache
-                                        video_history_key = f"video_history:{user_id}"
-                                        self._retry_operation(self.redis.delete, video_history_key)
-                                        stats["caches"] += 1
+                                        # Retire every cache entry tagged with the user
+                                        # (chat history pages, video history, balance, bootstrap)
+                                        if self.invalidate_tag(f"user:{user_id}"):
+                                            stats["caches"] += 1
                                         
                                         # Clean up conversation caches and data
                                         conv_pattern = f"conversation:*:{user_id}"
@@ -396,29 +453,703 @@ class RedisManager:
             logger.error(f"Error checking rate limit: {str(e)}")
             return True
 
-    def set_cache(self, cache_key: str, data: Any, ttl: Optional[int] = None) -> bool:
+    def _local_cache_get(self, key: str) -> Optional[Any]:
+        with self.local_cache_lock:
+            return self.local_cache.get(key)
+
+    def _local_cache_set(self, key: str, value: Any):
+        with self.local_cache_lock:
+            self.local_cache[key] = value
+
+    def _local_cache_drop(self, pattern: str):
+        """Drop one key, or every key matching a glob pattern, from the local tier"""
+        with self.local_cache_lock:
+            if not any(char in pattern for char in "*?["):
+                self.local_cache.pop(pattern, None)
+                return
+            for key in [key for key in self.local_cache if fnmatch.fnmatchcase(key, pattern)]:
+                self.local_cache.pop(key, None)
+
+    def _publish_invalidation(self, *patterns: str, pipe=None):
+        message = json.dumps({"node": self.node_id, "patterns": list(patterns)})
+        if pipe is not None:
+            pipe.publish(self.invalidation_channel, message)
+        else:
+            self._retry_operation(self.redis.publish, self.invalidation_channel, message)
+
+    def _handle_invalidation_message(self, message: Dict):
+        try:
+            payload = json.loads(message["data"])
+            if payload.get("node") != self.node_id:
+                for pattern in payload.get("patterns", []):
+                    self._local_cache_drop(pattern)
+                self._local_generations_update(payload.get("generations", {}))
+        except Exception as e:
+            logger.error(f"Error handling cache invalidation message: {str(e)}")
+
+    def _handle_invalidation_listener_error(self, error: Exception, pubsub, thread):
+        # Invalidations may have been missed while disconnected
+        logger.error(f"Cache invalidation listener error: {str(error)}")
+        with self.local_cache_lock:
+            self.local_cache.clear()
+            self.local_generations.clear()
+        time.sleep(self.retry_delay / 5)
+
+    def start_invalidation_listener(self):
+        """Subscribe to cross-node cache invalidations on a background thread"""
+        if self._invalidation_thread is not None:
+            return
+        self._invalidation_pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self._invalidation_pubsub.subscribe(**{self.invalidation_channel: self._handle_invalidation_message})
+        self._invalidation_thread = self._invalidation_pubsub.run_in_thread(
+            sleep_time=1.0,
+            daemon=True,
+            exception_handler=self._handle_invalidation_listener_error
+        )
+
+    def stop_invalidation_listener(self):
+        if self._invalidation_thread is None:
+            return
+        self._invalidation_thread.stop()
+        self._invalidation_pubsub.close()
+        self._invalidation_thread = None
+        self._invalidation_pubsub = None
+
+    CACHE_LATENCY_BUCKETS_MS = (0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+
+    def _cache_family_stats(self, key: str) -> Dict[str, Any]:
+        """Stats for a key's family: the part before the first ':'"""
+        family = key.split(":", 1)[0]
+        stats = self.cache_stats.get(family)
+        if stats is None:
+            buckets = len(self.CACHE_LATENCY_BUCKETS_MS) + 1
+            stats = self.cache_stats[family] = {
+                "hits": 0, "local_hits": 0, "stale_hits": 0, "misses": 0,
+                "sets": 0, "stale_sets": 0, "invalidations": 0, "errors": 0,
+                "bytes_read": 0, "bytes_written": 0,
+                "get": {"buckets": [0] * buckets, "total_ms": 0.0, "max_ms": 0.0},
+                "set": {"buckets": [0] * buckets, "total_ms": 0.0, "max_ms": 0.0}
+            }
+        return stats
+
+    def _record_cache_op(self, stats: Dict[str, Any], operation: str, outcome: str, started: float):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if outcome == "local_hits":
+            stats["hits"] += 1
+        stats[outcome] += 1
+        latency = stats[operation]
+        latency["buckets"][bisect.bisect_left(self.CACHE_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        latency["total_ms"] += elapsed_ms
+        latency["max_ms"] = max(latency["max_ms"], elapsed_ms)
+
+    def get_cache_metrics(self) -> Dict[str, Any]:
+        """Per key family hit rates, volumes and get/set latency histograms"""
+        metrics = {}
+        for family, stats in self.cache_stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            redis_hits = stats["hits"] - stats["local_hits"]
+            family_metrics = {
+                name: stats[name]
+                for name in (
+                    "hits", "local_hits", "stale_hits", "misses", "sets", "stale_sets",
+                    "invalidations", "errors", "bytes_read", "bytes_written"
+                )
+            }
+            family_metrics["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0
+            family_metrics["avg_value_bytes"] = round(stats["bytes_read"] / redis_hits) if redis_hits else 0
+            for operation in ("get", "set"):
+                latency = stats[operation]
+                count = sum(latency["buckets"])
+                # Cumulative counts per upper bound, Prometheus-style
+                cumulative, running = {}, 0
+                for bound, bucket_count in zip(self.CACHE_LATENCY_BUCKETS_MS + ("+Inf",), latency["buckets"]):
+                    running += bucket_count
+                    cumulative[str(bound)] = running
+                family_metrics[f"{operation}_latency_ms"] = {
+                    "count": count,
+                    "avg": round(latency["total_ms"] / count, 3) if count else 0,
+                    "max": round(latency["max_ms"], 3),
+                    "le": cumulative
+                }
+            metrics[family] = family_metrics
+        return metrics
+
+    def _generation_key(self, tag: str) -> str:
+        return self._build_key(self.cache_generation_prefix, tag)
+
+    @staticmethod
+    def _generation_seed() -> int:
+        """Starting value for a missing generation counter: the time in ms"""
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _versioned_key(key: str, generations: Optional[Tuple[int, ...]]) -> str:
+        if not generations:
+            return key
+        return f"{key}@{'.'.join(str(generation) for generation in generations)}"
+
+    def _local_generations_get(self, tags: List[str]) -> Optional[Tuple[int, ...]]:
+        with self.local_cache_lock:
+            generations = tuple(self.local_generations.get(tag) for tag in tags)
+        return None if None in generations else generations
+
+    def _local_generations_update(self, generations: Dict[str, int]):
+        """Record generations seen in Redis; counters only move forward"""
+        with self.local_cache_lock:
+            for tag, generation in generations.items():
+                current = self.local_generations.get(tag)
+                if current is None or generation > current:
+                    self.local_generations[tag] = generation
+
+    def _set_cache_entry(
+        self,
+        cache_key: str,
+        data: Any,
+        ttl: int,
+        tags: List[str],
+        generations: Optional[Tuple[int, ...]] = None,
+        raw: bool = False
+    ) -> bool:
+        """
+        Store a value under the current generations of `tags`. If `generations`
+        is given and any tag has moved on since, the value is stale and dropped.
+        With `raw`, `data` is bytes stored as-is.
+        """
+        stats = self._cache_family_stats(cache_key)
+        started = time.perf_counter()
+        outcome = "errors"
         try:
             key = self._build_key(self.cache_prefix, cache_key)
-            serialized_data = self._serialize_value(data)
-            return bool(self._retry_operation(self.redis.set, key, serialized_data, ex=(ttl or self.cache_ttl)))
+            serialized_data = data if raw else self._serialize_value(data)
+            stats["bytes_written"] += len(serialized_data)
+            if not tags:
+                with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.set(key, serialized_data, ex=ttl)
+                    # Other nodes drop their now-stale local copy
+                    self._publish_invalidation(key, pipe=pipe)
+                    result = self._retry_operation(pipe.execute)[0]
+                self._local_cache_set(key, data)
+                outcome = "sets"
+                return bool(result)
+
+            stored = self._retry_operation(
+                self.redis.eval,
+                self._SET_VERSIONED_SCRIPT,
+                len(tags),
+                *[self._generation_key(tag) for tag in tags],
+                key,
+                serialized_data,
+                ttl,
+                self.invalidation_channel,
+                self.node_id,
+                self.cache_generation_ttl,
+                self._generation_seed(),
+                *(generations or ())
+            )
+            if not stored:
+                outcome = "stale_sets"
+                return False
+            stored = tuple(stored)
+            self._local_generations_update(dict(zip(tags, stored)))
+            self._local_cache_set(self._versioned_key(key, stored), data)
+            outcome = "sets"
+            return True
+        finally:
+            self._record_cache_op(stats, "set", outcome, started)
+
+    def _get_cache_entry(
+        self,
+        cache_key: str,
+        tags: List[str],
+        raw: bool = False
+    ) -> Tuple[Optional[Any], Optional[Tuple[int, ...]]]:
+        """
+        Read a cached value and the generations it was looked up under. The
+        generation counters and the value are fetched in one round trip.
+        """
+        stats = self._cache_family_stats(cache_key)
+        started = time.perf_counter()
+        outcome = "errors"
+        try:
+            key = self._build_key(self.cache_prefix, cache_key)
+            if not tags:
+                local = self._local_cache_get(key)
+                if local is not None:
+                    outcome = "local_hits"
+                    return local, None
+                data = self._retry_operation(self.redis.get, key)
+                generations = None
+            else:
+                generations = self._local_generations_get(tags)
+                if generations is not None:
+                    local = self._local_cache_get(self._versioned_key(key, generations))
+                    if local is not None:
+                        outcome = "local_hits"
+                        return local, generations
+                data, *generations = self._retry_operation(
+                    self.redis.eval,
+                    self._GET_VERSIONED_SCRIPT,
+                    len(tags),
+                    *[self._generation_key(tag) for tag in tags],
+                    key,
+                    self.cache_generation_ttl,
+                    self._generation_seed()
+                )
+                generations = tuple(generations)
+                self._local_generations_update(dict(zip(tags, generations)))
+                key = self._versioned_key(key, generations)
+            if not data:
+                outcome = "misses"
+                return None, generations
+            stats["bytes_read"] += len(data)
+            value = data if raw else self._deserialize_value(data, dict)
+            if value is not None:
+                self._local_cache_set(key, value)
+            outcome = "hits" if value is not None else "misses"
+            return value, generations
+        finally:
+            self._record_cache_op(stats, "get", outcome, started)
+
+    def get_cache_bytes(
+        self,
+        cache_key: str,
+        tags: Optional[List[str]] = None
+    ) -> Tuple[Optional[bytes], Optional[Tuple[int, ...]]]:
+        """
+        Read bytes stored by set_cache_bytes without decoding them, plus the
+        generations they were looked up under for a later set_cache_bytes.
+        """
+        try:
+            return self._get_cache_entry(cache_key, tags or [], raw=True)
+        except Exception as e:
+            logger.error(f"Error getting cache: {str(e)}")
+            return None, None
+
+    def set_cache_bytes(
+        self,
+        cache_key: str,
+        data: bytes,
+        ttl: Optional[int] = None,
+        tags: Optional[List[str]] = None,
+        generations: Optional[Tuple[int, ...]] = None
+    ) -> bool:
+        """Store already-encoded bytes; dropped if `generations` is no longer current"""
+        try:
+            return self._set_cache_entry(cache_key, data, ttl or self.cache_ttl, tags or [], generations, raw=True)
         except Exception as e:
             logger.error(f"Error setting cache: {str(e)}")
+            self._local_cache_drop(self._build_key(self.cache_prefix, cache_key))
             return False
 
-    def get_cache(self, cache_key: str) -> Optional[Any]:
+    def get_generations(self, tags: List[str]) -> Optional[Tuple[int, ...]]:
+        """Current generations of `tags`, from the local tier if known; None on error"""
+        generations = self._local_generations_get(tags)
+        if generations is not None:
+            return generations
         try:
-            key = self._build_key(self.cache_prefix, cache_key)
-            data = self._retry_operation(self.redis.get, key)
-            if data:
-                return self._deserialize_value(data, dict)
+            generations = tuple(self._retry_operation(
+                self.redis.eval,
+                self._GET_GENERATIONS_SCRIPT,
+                len(tags),
+                *[self._generation_key(tag) for tag in tags],
+                self.cache_generation_ttl,
+                self._generation_seed()
+            ))
+            self._local_generations_update(dict(zip(tags, generations)))
+            return generations
+        except Exception as e:
+            logger.error(f"Error getting cache generations: {str(e)}")
             return None
+
+    def set_cache(self, cache_key: str, data: Any, ttl: Optional[int] = None, tags: Optional[List[str]] = None) -> bool:
+        """Cache a value; invalidate_tag on any of `tags` makes it unreachable"""
+        try:
+            return self._set_cache_entry(cache_key, data, ttl or self.cache_ttl, tags or [])
+        except Exception as e:
+            logger.error(f"Error setting cache: {str(e)}")
+            self._local_cache_drop(self._build_key(self.cache_prefix, cache_key))
+            return False
+
+    def get_cache(self, cache_key: str, tags: Optional[List[str]] = None) -> Optional[Any]:
+        """
+        Read a cached value stored with the same `tags`, from the local tier if
+        present.
+
+        Values served from the local tier are shared between callers and must
+        not be mutated.
+        """
+        try:
+            return self._get_cache_entry(cache_key, tags or [])[0]
         except Exception as e:
             logger.error(f"Error getting cache: {str(e)}")
             return None
 
-    def invalidate_cache(self, pattern: str) -> bool:
+    def mark_user_verified(self, user_id: str) -> bool:
+        """Record that a user exists so existence checks can skip the database"""
+        user_id = str(user_id)
+        if user_id in self.local_verified_users:
+            return True
+        self.local_verified_users[user_id] = True
+        try:
+            expires_at = time.time() + self.verified_user_ttl
+            with self.redis.pipeline() as pipe:
+                pipe.zadd(self.verified_users_key, {user_id: expires_at})
+                # Trim expired members opportunistically
+                pipe.zremrangebyscore(self.verified_users_key, 0, time.time())
+                pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Error marking user verified: {str(e)}")
+            return False
+
+    def is_user_verified(self, user_id: str) -> bool:
+        """Check the in-process set first, then the shared Redis set"""
+        user_id = str(user_id)
+        if user_id in self.local_verified_users:
+            return True
+        try:
+            expires_at = self._retry_operation(self.redis.zscore, self.verified_users_key, user_id)
+            if expires_at is not None and expires_at > time.time():
+                self.local_verified_users[user_id] = True
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"Error checking verified user: {str(e)}")
+            return False
+
+    def remove_verified_user(self, user_id: str) -> bool:
+        """Drop a user from the verified set, e.g. when the user is deleted"""
+        user_id = str(user_id)
+        self.local_verified_users.pop(user_id, None)
+        try:
+            self._retry_operation(self.redis.zrem, self.verified_users_key, user_id)
+            return True
+        except Exception as e:
+            logger.error(f"Error removing verified user: {str(e)}")
+            return False
+
+    # Generations are never reused, so neither are the ETags derived from them:
+    # a counter that is missing (never bumped, or expired) is seeded with the
+    # current time in ms on first read or bump, which is past any value it held
+    # before it expired.
+    _GENERATION_OF = """
+local function generation_of(key, ttl, seed)
+    local generation = tonumber(redis.call('get', key))
+    if not generation then
+        generation = tonumber(seed)
+        redis.call('set', key, generation, 'EX', ttl)
+    end
+    return generation
+end
+"""
+
+    # KEYS: generation counters; ARGV: counter ttl, seed. Returns the generations
+    _GET_GENERATIONS_SCRIPT = _GENERATION_OF + """
+local generations = {}
+for i, key in ipairs(KEYS) do
+    generations[i] = generation_of(key, ARGV[1], ARGV[2])
+end
+return generations
+"""
+
+    # KEYS: generation counters; ARGV: base key, counter ttl, seed
+    # Returns {value, generations...}
+    _GET_VERSIONED_SCRIPT = _GENERATION_OF + """
+local generations = {}
+for i, key in ipairs(KEYS) do
+    generations[i] = generation_of(key, ARGV[2], ARGV[3])
+end
+local value = redis.call('get', ARGV[1] .. '@' .. table.concat(generations, '.'))
+return {value, unpack(generations)}
+"""
+
+    # KEYS: generation counter; ARGV: ttl, seed
+    _BUMP_GENERATION_SCRIPT = """
+local generation = redis.call('incr', KEYS[1])
+if generation == 1 then
+    generation = tonumber(ARGV[2])
+    redis.call('set', KEYS[1], generation)
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return generation
+"""
+
+    # KEYS: generation counters
+    # ARGV: base key, value, ttl, invalidation channel, node id, counter ttl,
+    # seed, expected generations...
+    # Returns the generations written under, or nil if one no longer matches.
+    _SET_VERSIONED_SCRIPT = _GENERATION_OF + """
+local ttl = tonumber(ARGV[3])
+local generations = {}
+for i, key in ipairs(KEYS) do
+    local generation = generation_of(key, ARGV[6], ARGV[7])
+    if ARGV[7 + i] and tonumber(ARGV[7 + i]) ~= generation then
+        return nil
+    end
+    generations[i] = generation
+    if redis.call('ttl', key) < ttl then
+        redis.call('expire', key, ttl)
+    end
+end
+local key = ARGV[1] .. '@' .. table.concat(generations, '.')
+redis.call('set', key, ARGV[2], 'EX', ttl)
+-- Other nodes drop their now-stale local copy
+redis.call('publish', ARGV[4], cjson.encode({node = ARGV[5], patterns = {key}}))
+return generations
+"""
+
+    _RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+    @staticmethod
+    def _is_cache_entry(value: Any) -> bool:
+        return isinstance(value, dict) and value.get("__cache_entry__") == 1
+
+    def _should_refresh_early(self, entry: Dict, beta: float) -> bool:
+        """
+        Probabilistic early expiration (XFetch): the closer an entry is to its
+        expiry, and the slower it is to recompute, the likelier a reader is to
+        refresh it ahead of time, so refreshes spread out instead of piling up
+        at the TTL boundary.
+        """
+        delta = entry.get("delta", 0)
+        if not delta or beta <= 0:
+            return False
+        return time.time() - delta * beta * math.log(1.0 - random.random()) >= entry["expires_at"]
+
+    def _acquire_load_lock(self, lock_key: str, token: str) -> bool:
+        try:
+            return bool(self._retry_operation(
+                self.redis.set, lock_key, token, nx=True, px=self.cache_lock_ms
+            ))
+        except Exception as e:
+            # Loading without the lock beats failing the request
+            logger.error(f"Error acquiring cache load lock: {str(e)}")
+            return True
+
+    def _release_load_lock(self, lock_key: str, token: str):
+        try:
+            self._retry_operation(self.redis.eval, self._RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.error(f"Error releasing cache load lock: {str(e)}")
+
+    async def _load_and_store(
+        self,
+        cache_key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int,
+        tags: List[str],
+        generations: Optional[Tuple[int, ...]],
+        stale_ttl: int = 0
+    ) -> Any:
+        started = time.monotonic()
+        value = await loader()
+        delta = time.monotonic() - started
+        if value is not None:
+            # expires_at is the soft expiry; with stale_ttl the entry stays in
+            # Redis past it and is served stale while it refreshes
+            entry = {
+                "__cache_entry__": 1,
+                "value": value,
+                "delta": round(delta, 4),
+                "expires_at": time.time() + ttl
+            }
+            try:
+                # Stored under the generations seen before loading, so a load
+                # that raced an invalidation is discarded rather than cached
+                self._set_cache_entry(cache_key, entry, ttl + stale_ttl, tags, generations)
+            except Exception as e:
+                logger.error(f"Error setting cache: {str(e)}")
+        return value
+
+    async def _load_with_lock(
+        self,
+        cache_key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int,
+        tags: List[str],
+        generations: Optional[Tuple[int, ...]],
+        stale_ttl: int = 0
+    ) -> Any:
+        lock_key = self._versioned_key(self._build_key(self.cache_lock_prefix, cache_key), generations)
+        token = uuid.uuid4().hex
+        acquired = self._acquire_load_lock(lock_key, token)
+        if not acquired:
+            # Another process is loading; wait for its result rather than piling on
+            deadline = time.monotonic() + self.cache_lock_ms / 1000
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.cache_lock_poll_interval)
+                cached = self.get_cache(cache_key, tags)
+                if cached is not None:
+                    return cached["value"] if self._is_cache_entry(cached) else cached
+            logger.warning(f"Timed out waiting for cache load of {cache_key}, loading directly")
+        try:
+            return await self._load_and_store(cache_key, loader, ttl, tags, generations, stale_ttl)
+        finally:
+            if acquired:
+                self._release_load_lock(lock_key, token)
+
+    async def _refresh_early(
+        self,
+        cache_key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int,
+        tags: List[str],
+        generations: Optional[Tuple[int, ...]],
+        stale_ttl: int = 0
+    ) -> Optional[Any]:
+        """Refresh ahead of expiry if nobody else is; returns None if skipped"""
+        full_key = self._versioned_key(self._build_key(self.cache_prefix, cache_key), generations)
+        if full_key in self._inflight_loads:
+            return None
+        lock_key = self._versioned_key(self._build_key(self.cache_lock_prefix, cache_key), generations)
+        token = uuid.uuid4().hex
+        if not self._acquire_load_lock(lock_key, token):
+            return None
+        try:
+            return await self._load_and_store(cache_key, loader, ttl, tags, generations, stale_ttl)
+        except Exception as e:
+            logger.error(f"Error refreshing cache entry {cache_key} early: {str(e)}")
+            return None
+        finally:
+            self._release_load_lock(lock_key, token)
+
+    def _refresh_in_background(
+        self,
+        cache_key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int,
+        tags: List[str],
+        generations: Optional[Tuple[int, ...]],
+        stale_ttl: int
+    ):
+        full_key = self._versioned_key(self._build_key(self.cache_prefix, cache_key), generations)
+        if full_key in self._background_refreshes:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._refresh_early(cache_key, loader, ttl, tags, generations, stale_ttl)
+        )
+        self._background_refreshes[full_key] = task
+        task.add_done_callback(lambda _: self._background_refreshes.pop(full_key, None))
+
+    async def get_or_load(
+        self,
+        cache_key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: Optional[int] = None,
+        tags: Optional[List[str]] = None,
+        early_refresh_beta: Optional[float] = None,
+        stale_ttl: int = 0
+    ) -> Any:
+        """
+        Read-through cache. On a miss, concurrent callers in this process share
+        one loader call and other processes wait on a short Redis lock, so a
+        popular key that was just invalidated reaches the database once.
+
+        With `stale_ttl`, entries are kept for that long past `ttl` and served
+        stale during that window while a background task refreshes them.
+        Entries dropped by invalidate_tag are never served stale.
+        """
+        ttl = ttl or self.cache_ttl
+        tags = tags or []
+        beta = self.cache_early_refresh_beta if early_refresh_beta is None else early_refresh_beta
+        try:
+            cached, generations = self._get_cache_entry(cache_key, tags)
+        except Exception as e:
+            logger.error(f"Error getting cache: {str(e)}")
+            cached, generations = None, None
+        if cached is not None:
+            if not self._is_cache_entry(cached):
+                # Written by plain set_cache
+                return cached
+            stale = time.time() >= cached["expires_at"]
+            if stale_ttl and (stale or self._should_refresh_early(cached, beta)):
+                if stale:
+                    self._cache_family_stats(cache_key)["stale_hits"] += 1
+                self._refresh_in_background(cache_key, loader, ttl, tags, generations, stale_ttl)
+            elif self._should_refresh_early(cached, beta):
+                refreshed = await self._refresh_early(cache_key, loader, ttl, tags, generations)
+                if refreshed is not None:
+                    return refreshed
+            return cached["value"]
+
+        # Callers that saw a newer generation never join a load of an older one
+        full_key = self._versioned_key(self._build_key(self.cache_prefix, cache_key), generations)
+        inflight = self._inflight_loads.get(full_key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting; keep a failed load from logging "never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight_loads[full_key] = future
+        try:
+            value = await self._load_with_lock(cache_key, loader, ttl, tags, generations, stale_ttl)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight_loads.pop(full_key, None)
+
+    def invalidate_cache(self, cache_key: str) -> bool:
+        """Delete one cache entry by exact key"""
+        try:
+            key = self._build_key(self.cache_prefix, cache_key)
+            self._cache_family_stats(cache_key)["invalidations"] += 1
+            self._local_cache_drop(key)
+            self._retry_operation(self.redis.delete, key)
+            # Publish after the delete so no node can refill from the old value
+            self._publish_invalidation(key)
+            return True
+        except Exception as e:
+            logger.error(f"Error invalidating cache: {str(e)}")
+            return False
+
+    def invalidate_tag(self, *tags: str) -> bool:
+        """
+        Invalidate every cache entry stored under any of `tags` by bumping
+        their generation counters; the old entries expire by TTL.
+        """
+        if not tags:
+            return True
+        try:
+            seed = self._generation_seed()
+            with self.redis.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.eval(self._BUMP_GENERATION_SCRIPT, 1, self._generation_key(tag), self.cache_generation_ttl, seed)
+                results = self._retry_operation(pipe.execute)
+            generations = dict(zip(tags, results))
+            self._local_generations_update(generations)
+            for tag in tags:
+                self._cache_family_stats(tag)["invalidations"] += 1
+            self._retry_operation(
+                self.redis.publish,
+                self.invalidation_channel,
+                json.dumps({"node": self.node_id, "generations": generations})
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error invalidating cache tags {', '.join(tags)}: {str(e)}")
+            return False
+
+    def invalidate_cache_pattern(self, pattern: str) -> bool:
+        """
+        Delete cache entries matching a glob pattern.
+
+        This SCANs the whole keyspace; use exact keys or tags on request paths.
+        """
         try:
             pattern = self._build_key(self.cache_prefix, pattern)
+            self._local_cache_drop(pattern)
             cursor = 0
             deleted_keys = 0
             while True:
@@ -426,8 +1157,11 @@ class RedisManager:
                 if keys:
                     self._retry_operation(self.redis.delete, *keys)
                     deleted_keys += len(keys)
+                    self._cache_family_stats(pattern[len(self.cache_prefix):])["invalidations"] += len(keys)
                 if cursor == 0:
                     break
+            # Publish after the delete so no node can refill from the old value
+            self._publish_invalidation(pattern)
             return True
         except Exception as e:
             logger.error(f"Error invalidating cache: {str(e)}")
@@ -456,12 +1190,7 @@ class RedisManager:
         
     def invalidate_analysis_cache(self, user_id: str) -> bool:
         """Invalidate video analysis cache for a specific user"""
-        try:
-            cache_key = f"{self.cache_prefix}video_history:{user_id}"
-            return bool(self._retry_operation(self.redis.delete, cache_key))
-        except Exception as e:
-            logger.error(f"Error invalidating analysis cache: {str(e)}")
-            return False
+        return self.invalidate_tag(f"video_history:{user_id}")
 
     def enqueue_task(self, task_type: TaskType, payload: Dict[str, Any], priority: TaskPriority = TaskPriority.MEDIUM) -> Optional[str]:
         try:
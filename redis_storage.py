@@ -1,6 +1,7 @@
 import os
 import redis
 import zlib
+import json
 import logging
 from typing import Optional, List, Union, Any
 import asyncio
@@ -21,6 +22,9 @@ class RedisFileStorage:
         self.video_prefix = "video:"
         self.cache_prefix = "cache:"
         self.rate_prefix = "rate:"
+        self.gemini_file_prefix = "gemini_file:"
+        # Stop reusing a Gemini file this long before the Files API expires it
+        self.gemini_expiry_margin = 600
 
     def _should_compress(self, file_size: int) -> bool:
         return file_size > self.compression_threshold
@@ -258,3 +262,51 @@ class RedisFileStorage:
 
         except Exception as e:
             logger.error(f"Error in cleanup task: {str(e)}")
+
+    async def get_gemini_file(self, digest: str) -> Optional[dict]:
+        """Get the Gemini file handle recorded for a content digest"""
+        try:
+            record = self.redis_client.hgetall(f"{self.gemini_file_prefix}{digest}")
+            if not record:
+                return None
+            expires_at = self._decode_metadata(record[b'expires_at'], float)
+            if expires_at - self.gemini_expiry_margin <= time.time():
+                return None
+            metadata = record.get(b'metadata')
+            return {
+                'name': self._decode_metadata(record[b'name'], str),
+                'expires_at': expires_at,
+                'metadata': json.loads(metadata) if metadata else None
+            }
+        except Exception as e:
+            logger.error(f"Error getting Gemini file handle for {digest}: {str(e)}")
+            return None
+
+    async def set_gemini_file(self, digest: str, name: str, expires_at: float, metadata: Optional[dict] = None) -> bool:
+        """Record the Gemini file handle for a content digest until it expires"""
+        try:
+            ttl = int(expires_at - time.time() - self.gemini_expiry_margin)
+            if ttl <= 0:
+                return False
+            key = f"{self.gemini_file_prefix}{digest}"
+            with self.redis_client.pipeline() as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping={
+                    'name': name,
+                    'expires_at': self._encode_metadata(expires_at),
+                    'metadata': json.dumps(metadata) if metadata else ''
+                })
+                pipe.expire(key, ttl)
+                pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Error storing Gemini file handle for {digest}: {str(e)}")
+            return False
+
+    async def delete_gemini_file(self, digest: str) -> bool:
+        """Forget a Gemini file handle that is no longer usable"""
+        try:
+            return bool(self.redis_client.delete(f"{self.gemini_file_prefix}{digest}"))
+        except Exception as e:
+            logger.error(f"Error deleting Gemini file handle for {digest}: {str(e)}")
+            return False
@@ -0,0 +1,72 @@
+import gzip
+import logging
+from typing import Any, List, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from database import redis_manager
+
+logger = logging.getLogger(__name__)
+
+# Matches GZipMiddleware(minimum_size=1000) in app.py; smaller bodies are sent as-is
+GZIP_MIN_SIZE = 1000
+GZIP_LEVEL = 6
+
+# The gzip variant of a small body holds the identity bytes instead, so a
+# client that accepts gzip always finds its variant in one lookup
+_GZIP_MARKER = b"g"
+_IDENTITY_MARKER = b"i"
+
+def accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "").lower()
+
+def _variant_key(cache_key: str, use_gzip: bool) -> str:
+    return f"{cache_key}:{'gzip' if use_gzip else 'identity'}"
+
+def _build_response(body: bytes, use_gzip: bool) -> Response:
+    headers = {"Vary": "Accept-Encoding"}
+    if use_gzip:
+        # GZipMiddleware leaves responses that already set Content-Encoding alone
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def get_cached_response(
+    request: Request,
+    cache_key: str,
+    tags: List[str]
+) -> Tuple[Optional[Response], Optional[Tuple[int, ...]]]:
+    """
+    Serve a rendered JSON response straight from the cached bytes.
+
+    Returns the response, or None plus the generations to pass to
+    cache_json_response on a miss.
+    """
+    use_gzip = accepts_gzip(request)
+    data, generations = redis_manager.get_cache_bytes(_variant_key(cache_key, use_gzip), tags)
+    if data is None:
+        return None, generations
+    if not use_gzip:
+        return _build_response(data, False), generations
+    return _build_response(data[1:], data[:1] == _GZIP_MARKER), generations
+
+def cache_json_response(
+    request: Request,
+    cache_key: str,
+    content: Any,
+    tags: List[str],
+    generations: Optional[Tuple[int, ...]] = None,
+    ttl: Optional[int] = None
+) -> Response:
+    """Render `content` once, cache the identity and gzip bodies, and respond"""
+    body = JSONResponse(content=content).body
+    if len(body) >= GZIP_MIN_SIZE:
+        gzip_variant = _GZIP_MARKER + gzip.compress(body, GZIP_LEVEL)
+    else:
+        gzip_variant = _IDENTITY_MARKER + body
+    redis_manager.set_cache_bytes(_variant_key(cache_key, False), body, ttl, tags, generations)
+    redis_manager.set_cache_bytes(_variant_key(cache_key, True), gzip_variant, ttl, tags, generations)
+
+    if accepts_gzip(request):
+        return _build_response(gzip_variant[1:], gzip_variant[:1] == _GZIP_MARKER)
+    return _build_response(body, False)
@@ -0,0 +1,82 @@
+import re
+
+# Upload filenames are stored as "<uuid>_<original name>"
+_uuid_prefix_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_')
+# Video metadata bullets get indented under their parent bullet.
+# ASCII-only case folding matches `term in line.lower()` exactly for these terms.
+_metadata_term_pattern = re.compile(r'duration:|format:|resolution:|fps:|size:', re.IGNORECASE | re.ASCII)
+
+LINE_SEPARATOR = '\n\n'
+
+class ResponseFormatter:
+    """
+    Incremental markdown normalizer for model responses.
+
+    Text can be fed in arbitrary chunks as it streams in; each call returns the
+    normalized markdown for the lines completed so far. The concatenation of
+    all `feed` results and `finish` is identical to `format_response` on the
+    full text.
+    """
+
+    def __init__(self, filename: str = ''):
+        self._pending = ''
+        self._emitted_any = False
+        self._filename = filename
+        self._clean_filename = _uuid_prefix_pattern.sub('', filename) if filename else ''
+        self._replace_filename = bool(filename) and filename != self._clean_filename
+        # Replacement runs on blocks of whole lines; a name spanning lines needs the whole text
+        self._buffer_all = self._replace_filename and '\n' in filename
+
+    def _emit(self, block: str) -> str:
+        """Normalize a block of complete lines"""
+        if self._replace_filename:
+            block = block.replace(self._filename, self._clean_filename)
+        out = []
+        append = out.append
+        search_terms = _metadata_term_pattern.search
+        for line in block.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            first = line[0]
+            if first == '#':
+                # Collapse "### Title" / "#Title" into "# Title"
+                line = '# ' + line.lstrip('#').lstrip()
+            elif first == '-' or first == '•':
+                line = '- ' + line[1:].lstrip()
+                # Every term ends in ':' so most bullets skip the regex entirely
+                if ':' in line and search_terms(line):
+                    line = '  ' + line
+            append(line)
+        if not out:
+            return ''
+        text = LINE_SEPARATOR.join(out)
+        if self._emitted_any:
+            return LINE_SEPARATOR + text
+        self._emitted_any = True
+        return text
+
+    def feed(self, chunk: str) -> str:
+        """Consume a chunk of text and return the markdown for any completed lines"""
+        if not chunk:
+            return ''
+        if self._buffer_all:
+            self._pending += chunk
+            return ''
+        newline = chunk.rfind('\n')
+        if newline == -1:
+            self._pending += chunk
+            return ''
+        block = self._pending + chunk[:newline]
+        self._pending = chunk[newline + 1:]
+        return self._emit(block)
+
+    def finish(self) -> str:
+        """Flush the trailing partial line"""
+        block, self._pending = self._pending, ''
+        return self._emit(block)
+
+def format_response(response: str, filename: str = '') -> str:
+    """Format a complete response with clean markdown structure"""
+    formatter = ResponseFormatter(filename)
+    return formatter.feed(response) + formatter.finish()
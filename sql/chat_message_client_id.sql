@@ -0,0 +1,13 @@
+-- Client-generated ID for each chat message, assigned when the message is
+-- buffered in Redis. database.flush_chat_messages upserts on it with
+--   POST /rest/v1/user_chat_history?on_conflict=client_id
+--   Prefer: resolution=ignore-duplicates
+-- so a batch that is written again (after a timeout, or by a second flusher
+-- once the lock expired) does not duplicate messages.
+alter table public.user_chat_history
+    add column if not exists client_id uuid;
+
+-- Not partial: ON CONFLICT (client_id) can only infer a full unique index.
+-- Rows written before this column existed keep a NULL, which never conflicts.
+create unique index if not exists user_chat_history_client_id_key
+    on public.user_chat_history (client_id);
@@ -0,0 +1,54 @@
+-- Denormalized per-conversation summary used by the conversation list:
+--   {"last_message": "...", "message_count": 12, "last_activity": "2024-..."}
+alter table public.conversations
+    add column if not exists summary jsonb not null default '{}'::jsonb;
+
+-- Fold a batch of newly written messages into a conversation's summary.
+-- Called from database.flush_chat_messages once per conversation per batch:
+--   POST /rest/v1/rpc/record_conversation_activity
+--   {"p_conversation_id": "...", "p_message_count": 3,
+--    "p_last_message": "...", "p_last_activity": "2024-..."}
+create or replace function public.record_conversation_activity(
+    p_conversation_id uuid,
+    p_message_count integer,
+    p_last_message text,
+    p_last_activity timestamptz
+)
+returns void
+language sql
+as $$
+    update public.conversations
+       set summary = jsonb_build_object(
+               'message_count', coalesce((summary->>'message_count')::integer, 0) + p_message_count,
+               -- Batches can land out of order; keep the newest message
+               'last_message', case
+                   when (summary->>'last_activity') is null
+                     or (summary->>'last_activity')::timestamptz <= p_last_activity
+                   then p_last_message
+                   else summary->>'last_message'
+               end,
+               'last_activity', greatest(
+                   (summary->>'last_activity')::timestamptz,
+                   p_last_activity
+               )
+           )
+     where id = p_conversation_id;
+$$;
+
+-- Backfill existing conversations
+update public.conversations c
+   set summary = jsonb_build_object(
+           'message_count', s.message_count,
+           'last_message', left(s.last_message, 120),
+           'last_activity', s.last_activity
+       )
+  from (
+      select distinct on (conversation_id)
+             conversation_id,
+             count(*) over (partition by conversation_id) as message_count,
+             message as last_message,
+             "TIMESTAMP" as last_activity
+        from public.user_chat_history
+       order by conversation_id, "TIMESTAMP" desc
+  ) s
+ where c.id = s.conversation_id;
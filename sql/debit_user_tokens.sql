@@ -0,0 +1,62 @@
+-- Atomically debit a user's token balance and record the usage.
+-- Called from database.update_token_usage through PostgREST RPC:
+--   POST /rest/v1/rpc/debit_user_tokens
+--   {"p_user_id": "...", "p_tokens": 42, "p_reservation_id": "..."}
+-- Returns one row with the new balance, or no rows if the user has no
+-- user_tokens entry yet (the caller initializes it and retries).
+--
+-- p_reservation_id is optional. When given, a debit that was already applied
+-- for that reservation is not applied again, so token_ledger can retry a
+-- charge whose first attempt timed out.
+alter table public.token_usage
+    add column if not exists reservation_id uuid;
+
+create unique index if not exists token_usage_reservation_id_key
+    on public.token_usage (reservation_id);
+
+drop function if exists public.debit_user_tokens(uuid, bigint);
+
+create or replace function public.debit_user_tokens(
+    p_user_id uuid,
+    p_tokens bigint,
+    p_reservation_id uuid default null
+)
+returns table (tokens bigint)
+language plpgsql
+as $$
+declare
+    new_balance bigint;
+begin
+    -- The row lock serializes concurrent debits for the same user, including
+    -- two attempts at the same reservation
+    select user_tokens.tokens into new_balance
+      from public.user_tokens
+     where user_tokens.user_id = p_user_id
+       for update;
+
+    if not found then
+        return;
+    end if;
+
+    if p_reservation_id is not null and exists (
+        select 1 from public.token_usage
+         where token_usage.reservation_id = p_reservation_id
+    ) then
+        tokens := new_balance;
+        return next;
+        return;
+    end if;
+
+    update public.user_tokens
+       set tokens = greatest(0, user_tokens.tokens - p_tokens),
+           updated_at = now()
+     where user_tokens.user_id = p_user_id
+    returning user_tokens.tokens into new_balance;
+
+    insert into public.token_usage (user_id, tokens_used, reservation_id)
+    values (p_user_id, p_tokens, p_reservation_id);
+
+    tokens := new_balance;
+    return next;
+end;
+$$;
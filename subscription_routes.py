@@ -130,12 +130,13 @@ async def get_current_subscription(
         
         # Always return Free tier if no subscription exists
         if not subscription or not subscription.get('stripe_customer_id'):
+            free_tier = await database.get_subscription_tier_by_name("Free")
             return {
                 "tier": "Free",
                 "status": "active",
                 "subscription_tiers": {
                     "tier_name": "Free",
-                    "tokens": 90
+                    "tokens": free_tier.get("tokens", 90)
                 }
             }
 
@@ -254,10 +255,6 @@ async def stripe_webhook(
                             tokens=tier_details['tokens']
                         )
                         
-                        # Invalidate any cached token balance
-                        cache_key = f"token_balance:{user_sub['user_id']}"
-                        redis_manager.invalidate_cache(cache_key)
-                        
                         logger.info(f"Updated user {user_sub['user_id']} to tier {tier_name} with {tier_details['tokens']} tokens")
                 
                 logger.info(f"Update result: {result}")
@@ -0,0 +1,103 @@
+import os
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+os.environ.setdefault("SUPABASE_URL", "http://supabase.test")
+os.environ.setdefault("SUPABASE_ANON_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.test")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import database
+
+CONVERSATION_ID = uuid.UUID("00000000-0000-0000-0000-0000000000c1")
+USER_ID = "00000000-0000-0000-0000-000000000001"
+
+def _build_rows():
+    # Several messages share a timestamp so pages have to break ties on id
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    offsets = [0, 1, 1, 1, 2, 3, 3, 4]
+    return [
+        {
+            "id": index + 1,
+            "user_id": USER_ID,
+            "conversation_id": str(CONVERSATION_ID),
+            "message": f"message {index + 1}",
+            "chat_type": "user",
+            "TIMESTAMP": (start + timedelta(seconds=offset)).isoformat()
+        }
+        for index, offset in enumerate(offsets)
+    ]
+
+ROWS = _build_rows()
+
+def _sort_key(row, column):
+    if column == "TIMESTAMP":
+        return datetime.fromisoformat(row["TIMESTAMP"])
+    return row[column]
+
+def _matches(row, column, expression):
+    op, value = expression.split(".", 1)
+    left = _sort_key(row, column)
+    right = datetime.fromisoformat(value) if column == "TIMESTAMP" else type(left)(value)
+    return {"eq": left == right, "gt": left > right, "lt": left < right}[op]
+
+def _postgrest(request: httpx.Request) -> httpx.Response:
+    """Evaluate the filters, order and limit PostgREST would apply to ROWS"""
+    rows = ROWS
+    for key, value in request.url.params.multi_items():
+        if key in ("select", "order", "limit"):
+            continue
+        rows = [row for row in rows if _matches(row, key, value)]
+    for term in reversed(request.url.params["order"].split(",")):
+        column, _, direction = term.partition(".")
+        rows = sorted(rows, key=lambda row: _sort_key(row, column), reverse=direction == "desc")
+    rows = rows[:int(request.url.params["limit"])]
+    return httpx.Response(200, json=rows)
+
+@pytest.fixture(autouse=True)
+def fake_postgrest(monkeypatch):
+    client = httpx.AsyncClient(
+        base_url="http://supabase.test/rest/v1",
+        transport=httpx.MockTransport(_postgrest)
+    )
+    monkeypatch.setattr(database, "_postgrest_client", database.PooledPostgrestClient(client))
+
+    async def load_uncached(cache_key, loader, **kwargs):
+        return await loader()
+
+    monkeypatch.setattr(database.redis_manager, "get_or_load", load_uncached)
+    # Every page, including the head, reads Postgres instead of the recent list
+    monkeypatch.setattr(database, "RECENT_MESSAGES_CAP", 0)
+    monkeypatch.setattr(database, "_get_pending_chat_rows", lambda key: [])
+
+def _newest_first():
+    return sorted(ROWS, key=lambda row: (_sort_key(row, "TIMESTAMP"), row["id"]), reverse=True)
+
+def test_before_cursor_pages_through_timestamp_ties():
+    async def walk():
+        seen, before = [], None
+        while True:
+            page = await database.get_conversation_messages_page(CONVERSATION_ID, 2, before=before)
+            seen.extend(row["id"] for row in page["messages"])
+            if not page["has_more"]:
+                return seen
+            before = page["next_cursor"]
+
+    assert asyncio.run(walk()) == [row["id"] for row in _newest_first()]
+
+def test_after_cursor_returns_newer_messages_across_timestamp_ties():
+    cursor = database.encode_cursor(ROWS[2])
+    page = asyncio.run(database.get_conversation_messages_page(CONVERSATION_ID, 50, after=cursor))
+    expected = [row["id"] for row in _newest_first() if row["id"] > ROWS[2]["id"]]
+    assert [row["id"] for row in page["messages"]] == expected
+    assert page["has_more"] is False
+
+def test_after_cursor_reports_more_when_the_burst_exceeds_the_limit():
+    cursor = database.encode_cursor(ROWS[0])
+    page = asyncio.run(database.get_conversation_messages_page(CONVERSATION_ID, 3, after=cursor))
+    # Oldest-first fetch, so the three messages right after the cursor come back
+    assert [row["id"] for row in page["messages"]] == [4, 3, 2]
+    assert page["has_more"] is True
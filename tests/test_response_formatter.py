@@ -0,0 +1,99 @@
+import re
+import random
+
+import pytest
+
+from response_formatter import ResponseFormatter, format_response
+
+FILENAME = "3f2b8c1e-9a4d-4e6f-8b7a-1c2d3e4f5a6b_summer_campaign.mp4"
+
+def legacy_format_response(response: str, filename: str = '') -> str:
+    """Chatbot._format_response before response_formatter.py replaced it"""
+    if filename:
+        uuid_pattern = r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_'
+        clean_filename = re.sub(uuid_pattern, '', filename)
+        response = response.replace(filename, clean_filename)
+
+    lines = response.split('\n')
+    formatted_lines = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            line = re.sub(r'^#+\s*', '# ', line)
+        if line.startswith('•') or line.startswith('-'):
+            line = re.sub(r'^[•-]\s*', '- ', line)
+            if any(term in line.lower() for term in ['duration:', 'format:', 'resolution:', 'fps:', 'size:']):
+                line = f"  {line}"
+        formatted_lines.append(line)
+
+    return '\n\n'.join(formatted_lines)
+
+ANALYSIS = f"""### Video Information
+- Filename: {FILENAME}
+• Duration: 0:01:32
+-Format: mp4
+  - RESOLUTION: 1920x1080
+-   FPS: 30
+- Size: 12.4 MB
+
+##Hook Analysis
+The first 3 seconds of {FILENAME} open on the product.\r
+* Strength: clear branding
+- Weakness: no caption in the first frame
+
+#    Recommendations
+1. Add captions
+- Tighten the intro: cut to 2s
+•
+-
+
+#
+Plain closing line with trailing spaces
+"""
+
+SAMPLES = [
+    ANALYSIS,
+    "",
+    "\n\n\n",
+    "single line without newline",
+    "- duration:3s\n- no terms here\n#\n##\n- résumé size: 4 MB",
+    "•bullet\n\t- tabbed bullet\n   ### indented heading\n - nbsp bullet",
+    "line one\r\nline two\r\n\r\n- Format: webm\r\n",
+]
+
+@pytest.mark.parametrize("text", SAMPLES)
+@pytest.mark.parametrize("filename", ["", FILENAME, "plain.mp4"])
+def test_format_response_matches_previous_implementation(text, filename):
+    assert format_response(text, filename) == legacy_format_response(text, filename)
+
+def _feed_in_chunks(text: str, filename: str, sizes) -> str:
+    formatter = ResponseFormatter(filename)
+    out, start = [], 0
+    for size in sizes:
+        out.append(formatter.feed(text[start:start + size]))
+        start += size
+    out.append(formatter.feed(text[start:]))
+    out.append(formatter.finish())
+    return "".join(out)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64])
+def test_chunked_feed_matches_a_single_feed(chunk_size):
+    expected = format_response(ANALYSIS, FILENAME)
+    sizes = [chunk_size] * (len(ANALYSIS) // chunk_size)
+    assert _feed_in_chunks(ANALYSIS, FILENAME, sizes) == expected
+
+def test_randomly_split_feed_matches_a_single_feed():
+    rng = random.Random(30)
+    for text in SAMPLES:
+        expected = format_response(text, FILENAME)
+        for _ in range(20):
+            sizes = [rng.randint(0, 12) for _ in range(len(text) // 4)]
+            assert _feed_in_chunks(text, FILENAME, sizes) == expected
+
+def test_filename_spanning_lines_is_replaced_across_chunks():
+    filename = "3f2b8c1e-9a4d-4e6f-8b7a-1c2d3e4f5a6b_two\nlines.mp4"
+    text = f"# Video\n- Filename: {filename}\n- Format: mp4"
+    expected = legacy_format_response(text, filename)
+    assert _feed_in_chunks(text, filename, [5] * (len(text) // 5)) == expected
@@ -0,0 +1,206 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from database import redis_manager, get_user_token_balance, update_token_usage, db, _execute
+
+logger = logging.getLogger(__name__)
+
+# Holds expire on their own if an analysis dies without committing or refunding
+RESERVATION_TTL = 900
+RECONCILE_INTERVAL = 60
+
+HOLDS_PREFIX = "token_holds:"
+HOLD_EXPIRY_PREFIX = "token_hold_expiry:"
+HOLD_USERS_KEY = "token_hold_users"
+# reservation_id -> {"user_id", "tokens"} for commits whose debit failed
+UNPAID_CHARGES_KEY = "token_unpaid_charges"
+
+# KEYS: holds hash, expiry zset, users-with-holds set
+# ARGV: reservation_id, tokens, balance, now, expires_at, ttl, user_id
+_RESERVE_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[4])
+for _, id in ipairs(expired) do
+    redis.call('hdel', KEYS[1], id)
+end
+if #expired > 0 then
+    redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[4])
+end
+
+local held = 0
+for _, value in ipairs(redis.call('hvals', KEYS[1])) do
+    held = held + tonumber(value)
+end
+
+local available = tonumber(ARGV[3]) - held
+if available < tonumber(ARGV[2]) then
+    return {0, available}
+end
+
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[5], ARGV[1])
+redis.call('expire', KEYS[1], ARGV[6])
+redis.call('expire', KEYS[2], ARGV[6])
+redis.call('sadd', KEYS[3], ARGV[7])
+return {1, available - tonumber(ARGV[2])}
+"""
+
+# KEYS: holds hash, expiry zset; ARGV: reservation_id. Returns the released amount.
+_RELEASE_SCRIPT = """
+local tokens = redis.call('hget', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('zrem', KEYS[2], ARGV[1])
+return tonumber(tokens) or 0
+"""
+
+# KEYS: holds hash, expiry zset; ARGV: now. Returns the tokens still held.
+_PURGE_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    redis.call('hdel', KEYS[1], id)
+end
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[1])
+local held = 0
+for _, value in ipairs(redis.call('hvals', KEYS[1])) do
+    held = held + tonumber(value)
+end
+return held
+"""
+
+_reserve = redis_manager.redis.register_script(_RESERVE_SCRIPT)
+_release = redis_manager.redis.register_script(_RELEASE_SCRIPT)
+_purge = redis_manager.redis.register_script(_PURGE_SCRIPT)
+
+def _hold_keys(user_id: str):
+    return f"{HOLDS_PREFIX}{user_id}", f"{HOLD_EXPIRY_PREFIX}{user_id}"
+
+async def reserve_tokens(user_id: uuid.UUID, tokens: int, ttl: int = RESERVATION_TTL) -> Optional[str]:
+    """
+    Hold `tokens` against the user's balance before starting expensive work.
+
+    Returns a reservation ID to commit or refund later, or None if the balance
+    minus all active holds cannot cover the request.
+    """
+    user_id = str(user_id)
+    balance = await get_user_token_balance(uuid.UUID(user_id))
+    reservation_id = str(uuid.uuid4())
+    now = time.time()
+    holds_key, expiry_key = _hold_keys(user_id)
+    accepted, available = _reserve(
+        keys=[holds_key, expiry_key, HOLD_USERS_KEY],
+        args=[reservation_id, tokens, balance, now, now + ttl, ttl, user_id]
+    )
+    if not accepted:
+        logger.info(f"Token reservation of {tokens} rejected for user {user_id}, available: {available}")
+        return None
+    logger.info(f"Reserved {tokens} tokens for user {user_id} ({reservation_id})")
+    return reservation_id
+
+async def refund_tokens(user_id: uuid.UUID, reservation_id: str) -> int:
+    """Release a hold without charging; returns the tokens released"""
+    holds_key, expiry_key = _hold_keys(str(user_id))
+    released = _release(keys=[holds_key, expiry_key], args=[reservation_id])
+    logger.info(f"Refunded reservation {reservation_id} for user {user_id} ({released} tokens)")
+    return released
+
+async def commit_tokens(user_id: uuid.UUID, reservation_id: str, tokens_used: int) -> int:
+    """
+    Charge the actual usage and release the hold; returns the new balance.
+
+    If the debit fails the charge is recorded as unpaid and the hold is kept, so
+    the tokens cannot be spent until reconcile_reservations retries it. The
+    retry passes the same reservation_id, so a debit that did go through
+    before the failure is not applied twice.
+    """
+    try:
+        new_balance = await update_token_usage(user_id, tokens_used, reservation_id)
+    except Exception as e:
+        redis_manager.redis.hset(
+            UNPAID_CHARGES_KEY, reservation_id,
+            json.dumps({"user_id": str(user_id), "tokens": tokens_used})
+        )
+        logger.error(
+            f"Failed to charge {tokens_used} tokens for reservation {reservation_id} "
+            f"of user {user_id}; will retry: {str(e)}"
+        )
+        raise
+    holds_key, expiry_key = _hold_keys(str(user_id))
+    _release(keys=[holds_key, expiry_key], args=[reservation_id])
+    return new_balance
+
+async def retry_unpaid_charges() -> int:
+    """Retry debits that failed in commit_tokens; returns how many went through"""
+    charged = 0
+    for raw_id, raw_charge in redis_manager.redis.hgetall(UNPAID_CHARGES_KEY).items():
+        reservation_id = raw_id.decode('utf-8')
+        charge = json.loads(raw_charge)
+        try:
+            await update_token_usage(uuid.UUID(charge["user_id"]), charge["tokens"], reservation_id)
+        except Exception as e:
+            logger.error(f"Retrying the charge for reservation {reservation_id} failed: {str(e)}")
+            continue
+        redis_manager.redis.hdel(UNPAID_CHARGES_KEY, reservation_id)
+        holds_key, expiry_key = _hold_keys(charge["user_id"])
+        _release(keys=[holds_key, expiry_key], args=[reservation_id])
+        charged += 1
+    return charged
+
+async def get_held_tokens(user_id: uuid.UUID) -> int:
+    """Tokens currently held by in-flight reservations"""
+    holds_key, expiry_key = _hold_keys(str(user_id))
+    return _purge(keys=[holds_key, expiry_key], args=[time.time()])
+
+async def reconcile_reservations() -> Dict[str, int]:
+    """Retry unpaid charges, drop expired holds and resync cached balances from user_tokens"""
+    stats = {"users": 0, "released_users": 0, "overcommitted": 0, "charged": 0}
+    # Before the purge below, so a hold backing an unpaid charge is not dropped
+    # while the charge is still outstanding
+    try:
+        stats["charged"] = await retry_unpaid_charges()
+    except Exception as e:
+        logger.error(f"Error retrying unpaid token charges: {str(e)}")
+    for raw_user_id in redis_manager.redis.smembers(HOLD_USERS_KEY):
+        user_id = raw_user_id.decode('utf-8')
+        stats["users"] += 1
+        try:
+            held = await get_held_tokens(uuid.UUID(user_id))
+            if not held:
+                redis_manager.redis.srem(HOLD_USERS_KEY, user_id)
+                stats["released_users"] += 1
+                continue
+
+            # Read the authoritative balance, bypassing the 30 s cache
+            response = await _execute(
+                "user_tokens.select",
+                db().table("user_tokens").select("tokens").eq("user_id", user_id)
+            )
+            if not response.data:
+                continue
+            balance = response.data[0]["tokens"]
+            # Invalidated rather than overwritten, so the next read reloads it and
+            # ETags derived from the balance change with it
+            redis_manager.invalidate_tag(f"token_balance:{user_id}", f"bootstrap:{user_id}")
+            if held > balance:
+                stats["overcommitted"] += 1
+                logger.warning(f"User {user_id} has {held} tokens held against a balance of {balance}")
+        except Exception as e:
+            logger.error(f"Error reconciling token reservations for user {user_id}: {str(e)}")
+    return stats
+
+async def run_reservation_reconciler():
+    while True:
+        try:
+            stats = await reconcile_reservations()
+            if stats["users"] or stats["charged"]:
+                logger.info(
+                    f"Token reservations reconciled - Users: {stats['users']}, "
+                    f"Released: {stats['released_users']}, "
+                    f"Overcommitted: {stats['overcommitted']}, "
+                    f"Charged: {stats['charged']}"
+                )
+        except Exception as e:
+            logger.error(f"Error in token reservation reconciler: {str(e)}")
+        await asyncio.sleep(RECONCILE_INTERVAL)